@@ -3,14 +3,27 @@ import datetime
 
 from django.contrib import admin
 from django.conf.urls.defaults import patterns, url
+from django.core.exceptions import PermissionDenied
 from django.http import HttpResponse
+from django.shortcuts import get_object_or_404
 
-from survey import constants
+from survey import constants, export
 from survey.models import (Questionnaire, ContentQuiz, MultiChoiceQuestion,
                            MultiChoiceOption, QuestionnaireHolodeckKeys,
                            AnswerSheet, MultiChoiceAnswer)
 
 
+def export_response(sheets, filename):
+    """ Stream the CSV export of the sheets as a download. The response
+        content is a generator, so the sheets are read and written a chunk at
+        a time instead of being loaded at once.
+    """
+    response = HttpResponse(export.stream_csv(sheets), mimetype='text/csv')
+    response['Content-Disposition'] = 'attachment; filename=%s_%s.csv' % (
+        filename, datetime.date.today().strftime('%Y%m%d'))
+    return response
+
+
 class MultiChoiceOptionAdmin(admin.TabularInline):
     model = MultiChoiceOption
 
@@ -31,6 +44,27 @@ class QuestionnaireAdmin(admin.ModelAdmin):
     read_only_fields = ('date_created',)
     raw_id_fields = ('created_by',)
 
+    def get_urls(self):
+        urls = super(QuestionnaireAdmin, self).get_urls()
+        info = self.model._meta.app_label, self.model._meta.module_name
+        export_urls = patterns('',
+            url(r'^(\d+)/export/$',
+                self.admin_site.admin_view(self.export_answer_sheets),
+                name='%s_%s_export' % info),
+        )
+        return export_urls + urls
+
+    def export_answer_sheets(self, request, object_id):
+        """ Download the answer sheets of a questionnaire as CSV.
+        """
+        if not self.has_change_permission(request):
+            raise PermissionDenied
+        questionnaire = get_object_or_404(self.queryset(request),
+                                          pk=object_id)
+        return export_response(
+            AnswerSheet.objects.filter(questionnaire=questionnaire),
+            'askMAMA_Survey_Answers_%s' % questionnaire.pk)
+
 admin.site.register(Questionnaire, QuestionnaireAdmin)
 
 
@@ -46,12 +80,18 @@ class MultiChoiceAnswerAdmin(admin.TabularInline):
 
 
 class AnswerSheetAdmin(admin.ModelAdmin):
-    list_display = ('questionnaire', 'user', 'date_created',)
+    list_display = ('questionnaire', 'user', 'date_created', 'status',)
+    list_filter = ('status',)
     date_hierarchy = 'date_created'
     search_fields = ('questionnaire', 'user',)
     read_only_fields = ('date_created',)
     raw_id_fields = ('questionnaire', 'user',)
     inlines = (MultiChoiceAnswerAdmin,)
+    actions = ('export_as_csv',)
+
+    def export_as_csv(self, request, queryset):
+        return export_response(queryset, 'askMAMA_Survey_Answers')
+    export_as_csv.short_description = 'Export selected answer sheets as CSV'
 
 admin.site.register(AnswerSheet, AnswerSheetAdmin)
 
@@ -0,0 +1,277 @@
+""" Shared cache helpers for the survey application.
+
+    Entries are stored together with the content version that was current
+    when they were computed. Bumping the content version invalidates the
+    entries for all users at once, without having to enumerate them. Entries
+    of a single user are also stored with the user's version, so that an
+    entry computed before the user's data changed is never taken as current.
+"""
+import time
+
+from django.core.cache import cache
+
+CONTENT_VERSION_KEY = 'survey:content-version'
+STATUS_MAP_KEY = 'survey:status-map:%s'
+PREREQUISITES_KEY = 'survey:prerequisites'
+ACTIVE_QUESTIONNAIRES_KEY = 'survey:active-questionnaires'
+NOTHING_AVAILABLE_KEY = 'survey:nothing-available:%s'
+STATS_KEY = 'survey:stats:%s'
+PAGE_TOKEN_KEY = 'survey:page-token:%s'
+FRAGMENT_KEY = 'survey:fragment:%s:%s:%s'
+SHEET_VERSION_KEY = 'survey:sheet-version:%s:%s'
+USER_VERSION_KEY = 'survey:user-version:%s'
+FLUSH_LOCK_KEY = 'survey:flush-lock'
+
+# entries expire after a day, even if never invalidated
+ENTRY_TIMEOUT = 60 * 60 * 24
+LONG_TIMEOUT = 60 * 60 * 24 * 30
+# a flush that runs longer than this no longer holds its lock
+FLUSH_LOCK_TIMEOUT = 60 * 10
+
+# incremented whenever this process invalidates cached data, so that values
+# memoized for the duration of a request can detect changes it made.
+local_generation = 0
+
+
+def _local_change():
+    global local_generation
+    local_generation += 1
+
+
+def _new_content_version():
+    # start from a timestamp so that a version lost to a cache eviction is
+    # never reused.
+    return int(time.time() * 1000)
+
+
+def get_content_version():
+    """ Return the current content version, initialising it if required.
+    """
+    version = cache.get(CONTENT_VERSION_KEY)
+    if version is None:
+        cache.add(CONTENT_VERSION_KEY, _new_content_version(), LONG_TIMEOUT)
+        version = cache.get(CONTENT_VERSION_KEY)
+    return version
+
+
+def bump_content_version():
+    """ Invalidate all the versioned entries.
+    """
+    _local_change()
+    try:
+        cache.incr(CONTENT_VERSION_KEY)
+    except ValueError:
+        cache.set(CONTENT_VERSION_KEY, _new_content_version(), LONG_TIMEOUT)
+
+
+def get_versioned(key):
+    """ Return the current content version and the value stored for a
+        versioned key. The value is None if it is missing or was stored for
+        an older content version.
+    """
+    result = cache.get_many([CONTENT_VERSION_KEY, key])
+    version = result.get(CONTENT_VERSION_KEY)
+    if version is None:
+        return get_content_version(), None
+    entry = result.get(key)
+    if entry is None or entry[0] != version:
+        return version, None
+    return version, entry[1]
+
+
+def set_versioned(key, version, value):
+    """ Store a value, computed while the given content version was
+        current.
+    """
+    cache.set(key, (version, value), ENTRY_TIMEOUT)
+
+
+def get_user_version(user_id):
+    """ Return the version of the user's data, which changes whenever
+        invalidate_user is called for them.
+    """
+    key = USER_VERSION_KEY % user_id
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, _new_content_version(), LONG_TIMEOUT)
+        version = cache.get(key)
+    return version
+
+
+def get_user_versioned(user_id, key):
+    """ Return the content and user versions and the value stored for a key
+        of the user. The value is None if it is missing or was stored for
+        older versions.
+    """
+    user_key = USER_VERSION_KEY % user_id
+    result = cache.get_many([CONTENT_VERSION_KEY, user_key, key])
+    content_version = result.get(CONTENT_VERSION_KEY)
+    if content_version is None:
+        content_version = get_content_version()
+    user_version = result.get(user_key)
+    if user_version is None:
+        user_version = get_user_version(user_id)
+    version = (content_version, user_version)
+    entry = result.get(key)
+    if entry is None or entry[0] != version:
+        return version, None
+    return version, entry[1]
+
+
+def get_status_map(user_id):
+    """ Return the content and user versions and the cached questionnaire id
+        to status map for the user. The map is None if it has to be
+        calculated.
+    """
+    version, statuses = get_user_versioned(user_id, STATUS_MAP_KEY % user_id)
+    if statuses is None:
+        incr_stat('status_map_misses')
+    else:
+        incr_stat('status_map_hits')
+    return version, statuses
+
+
+def set_status_map(user_id, version, statuses):
+    set_versioned(STATUS_MAP_KEY % user_id, version, statuses)
+
+
+def get_prerequisites():
+    """ Return the content version and the cached questionnaire id to
+        required questionnaire id map, or None if it has to be loaded.
+    """
+    return get_versioned(PREREQUISITES_KEY)
+
+
+def set_prerequisites(version, prerequisites):
+    set_versioned(PREREQUISITES_KEY, version, prerequisites)
+
+
+def get_active_questionnaires():
+    """ Return the content version and the cached list of active
+        questionnaire ids, or None if it has to be loaded.
+    """
+    return get_versioned(ACTIVE_QUESTIONNAIRES_KEY)
+
+
+def set_active_questionnaires(version, questionnaire_ids):
+    set_versioned(ACTIVE_QUESTIONNAIRES_KEY, version, questionnaire_ids)
+
+
+def get_nothing_available(user_id):
+    """ Return the content and user versions and whether the user was found
+        to have no questionnaire available. Lookups that find the marker are
+        counted as 'check_fast_path', those that don't as 'check_full_path'.
+    """
+    version, nothing_available = get_user_versioned(
+        user_id, NOTHING_AVAILABLE_KEY % user_id)
+    if nothing_available:
+        incr_stat('check_fast_path')
+    else:
+        incr_stat('check_full_path')
+    return version, bool(nothing_available)
+
+
+def set_nothing_available(user_id, version):
+    set_versioned(NOTHING_AVAILABLE_KEY % user_id, version, True)
+
+
+def invalidate_user(user_id):
+    """ Invalidate all the cached entries for the user. Bumping the user's
+        version also rejects entries that are being computed from the data
+        as it was before, and are only stored after this call.
+    """
+    _local_change()
+    try:
+        cache.incr(USER_VERSION_KEY % user_id)
+    except ValueError:
+        # the next lookup starts a new version
+        pass
+
+
+def get_sheet_version(user_id, questionnaire_id):
+    """ Return the version of the user's answers to a questionnaire, which
+        changes whenever answers are added or removed, on any device.
+    """
+    key = SHEET_VERSION_KEY % (user_id, questionnaire_id)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, _new_content_version(), LONG_TIMEOUT)
+        version = cache.get(key)
+    return version
+
+
+def bump_sheet_version(user_id, questionnaire_id):
+    try:
+        cache.incr(SHEET_VERSION_KEY % (user_id, questionnaire_id))
+    except ValueError:
+        # the next lookup starts a new version
+        pass
+
+
+def page_token_used(nonce):
+    """ Determine if the survey page with the given token nonce was
+        submitted before.
+    """
+    return cache.get(PAGE_TOKEN_KEY % nonce) is not None
+
+
+def use_page_token(nonce):
+    """ Mark the survey page with the given token nonce as submitted, once
+        its answers are stored. Returns False if it was submitted before.
+    """
+    return cache.add(PAGE_TOKEN_KEY % nonce, True, ENTRY_TIMEOUT)
+
+
+def acquire_flush_lock():
+    """ Claim the lock held while buffered answers are flushed. Returns
+        False if another flush holds it.
+    """
+    return cache.add(FLUSH_LOCK_KEY, True, FLUSH_LOCK_TIMEOUT)
+
+
+def release_flush_lock():
+    cache.delete(FLUSH_LOCK_KEY)
+
+
+def get_fragments(version, question_fields):
+    """ Return the cached html of (question id, field name) pairs rendered
+        for the content version, as a dict keyed by those pairs. Found and
+        missing fragments are counted as 'fragment_hits' and
+        'fragment_misses'.
+    """
+    keys = dict((FRAGMENT_KEY % (version, question_id, name),
+                 (question_id, name))
+                for question_id, name in question_fields)
+    result = cache.get_many(keys.keys())
+    fragments = dict((keys[key], html) for key, html in result.items())
+    if fragments:
+        incr_stat('fragment_hits', len(fragments))
+    if len(fragments) < len(keys):
+        incr_stat('fragment_misses', len(keys) - len(fragments))
+    return fragments
+
+
+def set_fragment(version, question_id, name, html):
+    cache.set(FRAGMENT_KEY % (version, question_id, name), html,
+              ENTRY_TIMEOUT)
+
+
+def incr_stat(name, delta=1):
+    key = STATS_KEY % name
+    try:
+        cache.incr(key, delta)
+    except ValueError:
+        if not cache.add(key, delta, LONG_TIMEOUT):
+            cache.incr(key, delta)
+
+
+def get_stats(*names):
+    """ Return the current value of the named counters, e.g.
+        get_stats('status_map_hits', 'status_map_misses').
+    """
+    result = cache.get_many([STATS_KEY % name for name in names])
+    return dict((name, result.get(STATS_KEY % name, 0)) for name in names)
+
+
+def reset_stats(*names):
+    cache.delete_many([STATS_KEY % name for name in names])
@@ -17,3 +17,10 @@ QUESTIONNAIRE_COMPLETED = 1
 QUESTIONNAIRE_INCOMPLETE = 2
 QUESTIONNAIRE_PENDING = 3
 QUESTIONNAIRE_REJECTED = 4
+
+QUESTIONNAIRE_STATUSES = (
+    (QUESTIONNAIRE_COMPLETED, 'Completed'),
+    (QUESTIONNAIRE_INCOMPLETE, 'Incomplete'),
+    (QUESTIONNAIRE_PENDING, 'Pending'),
+    (QUESTIONNAIRE_REJECTED, 'Rejected'),
+)
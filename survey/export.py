@@ -0,0 +1,662 @@
+""" Streaming export of answer sheets.
+
+    The sheets are read in chunks, using keyset pagination on the unique
+    (questionnaire, user) index, with a fixed number of flat queries per chunk
+    for the sheets, their answers and the users' profiles. Rows are produced
+    one at a time, so memory use does not grow with the number of sheets.
+"""
+import datetime
+import gzip
+import hashlib
+import json
+import multiprocessing
+import os
+import sys
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from snippetscream.csv_serializer import UnicodeWriter
+from django.db import connection
+from django.db.models import Max, Q
+from django.contrib.auth.models import User
+
+from survey import constants
+from survey.models import (Questionnaire, AnswerSheet, MultiChoiceAnswer,
+                           get_profile_model)
+from survey.snapshot import get_snapshot
+
+CHUNK_SIZE = 500
+
+# output files are written through a buffer of this size
+BUFFER_SIZE = 1024 * 1024
+
+HEADER = ['User', 'msisdn', 'Questionnaire', 'Date Submitted', 'Status',
+          'Score']
+
+STATUS_TEXT = dict(constants.QUESTIONNAIRE_STATUSES)
+
+# the last row of a streamed export that failed part way through
+STREAM_ERROR_ROW = ['EXPORT FAILED: this file is incomplete']
+
+WATERMARK_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+# sheets are stamped when their answers are saved, but only become visible
+# once that transaction commits, so incremental exports also include the
+# sheets updated this long before the watermark.
+WATERMARK_MARGIN = datetime.timedelta(minutes=5)
+
+WIDE_HEADER = ['User', 'msisdn', 'Date Submitted', 'Status', 'Score']
+
+MANIFEST_HEADER = ['Questionnaire ID', 'Questionnaire', 'File', 'Rows',
+                   'SHA1']
+
+
+def header_row(max_answers):
+    """ Return the header line for sheets with up to max_answers answers.
+    """
+    header_line = list(HEADER)
+    for idx in range(max_answers):
+        header_line.append('Question %s' % (idx+1))
+        header_line.append('Answer %s' % (idx+1))
+    return header_line
+
+
+def get_max_answers(sheets=None):
+    """ Return the most answers on any of the sheets, for the number of
+        question and answer columns of the header line.
+    """
+    if sheets is None:
+        return AnswerSheet.objects.get_max_answers()
+    return sheets.aggregate(
+        answers=Max('answers_count'))['answers'] or 0
+
+
+def iterate_sheet_chunks(sheets=None, chunk_size=CHUNK_SIZE, after=None):
+    """ Iterate over the sheets queryset in chunks ordered by questionnaire
+        and user. Each chunk is a list of (id, questionnaire id, user id,
+        username, questionnaire title, date created, status) tuples.
+
+        With after, a (questionnaire id, user id) tuple, only the sheets
+        following that sheet in this order are included.
+    """
+    if sheets is None:
+        sheets = AnswerSheet.objects.all()
+    qs = sheets.order_by('questionnaire__id', 'user__id').values_list(
+        'pk', 'questionnaire', 'user', 'user__username',
+        'questionnaire__title', 'date_created', 'status')
+    while True:
+        chunk_qs = qs
+        if after is not None:
+            chunk_qs = chunk_qs.filter(
+                Q(questionnaire__gt=after[0]) |
+                Q(questionnaire=after[0], user__gt=after[1]))
+        chunk = list(chunk_qs[:chunk_size])
+        if not chunk:
+            return
+        yield chunk
+        after = chunk[-1][1:3]
+
+
+def get_mobile_numbers(user_ids):
+    """ Return a dictionary of user id to mobile number for the users. The
+        numbers are read from the AUTH_PROFILE_MODULE model in one query if
+        there is one, or from each user's profile otherwise.
+    """
+    profile_model = get_profile_model()
+    if profile_model is not None:
+        return dict(profile_model.objects.filter(
+            user__in=user_ids).values_list('user', 'mobile_number'))
+    return dict((user.pk, user.profile.mobile_number)
+                for user in User.objects.filter(pk__in=user_ids))
+
+
+def get_answers(sheet_ids):
+    """ Return a dictionary of sheet id to the list of (question text, option
+        text, is correct) answers on the sheet, in question order.
+    """
+    answers = dict((sheet_id, []) for sheet_id in sheet_ids)
+    qs = MultiChoiceAnswer.objects.filter(answer_sheet__in=sheet_ids)
+    qs = qs.order_by('question__question_order', 'pk').values_list(
+        'answer_sheet', 'question__question_text',
+        'chosen_option__option_text', 'chosen_option__is_correct_option')
+    for sheet_id, question_text, option_text, is_correct in qs:
+        answers[sheet_id].append((question_text, option_text, is_correct))
+    return answers
+
+
+def chunk_rows(chunk):
+    """ Generate the export row of each of the sheets in a chunk. The scores
+        are counted from the answers fetched for the rows.
+    """
+    answers = get_answers([sheet[0] for sheet in chunk])
+    mobile_numbers = get_mobile_numbers(
+        set(sheet[2] for sheet in chunk))
+    for (sheet_id, questionnaire_id, user_id, username, title,
+            date_created, status) in chunk:
+        msisdn = mobile_numbers.get(user_id)
+        if msisdn is None:
+            msisdn = u'Unknown'
+        sheet_answers = answers[sheet_id]
+        data = [username, msisdn, title,
+                "%s" % date_created,
+                STATUS_TEXT.get(status, 'Unknown'),
+                "%s" % len([is_correct for question_text, option_text,
+                            is_correct in sheet_answers if is_correct])]
+        for question_text, option_text, is_correct in sheet_answers:
+            data.append(question_text)
+            data.append(option_text)
+        yield data
+
+
+def iterate_rows(sheets=None, chunk_size=CHUNK_SIZE):
+    """ Generate the export row of each of the sheets.
+    """
+    for chunk in iterate_sheet_chunks(sheets, chunk_size):
+        for row in chunk_rows(chunk):
+            yield row
+
+
+def iterate_wide_rows(questionnaire_id, sheets=None, chunk_size=CHUNK_SIZE):
+    """ Generate the header line and a row for each of the sheets of a
+        questionnaire, with a column for the chosen option of each question
+        in question order. Each chunk of sheets is pivoted in one pass over
+        its answers.
+    """
+    questions = get_snapshot(questionnaire_id).questions
+    columns = dict((the_question.pk, idx)
+                   for idx, the_question in enumerate(questions))
+    yield WIDE_HEADER + [the_question.question_text
+                         for the_question in questions]
+
+    if sheets is None:
+        sheets = AnswerSheet.objects.all()
+    sheets = sheets.filter(questionnaire=questionnaire_id)
+    for chunk in iterate_sheet_chunks(sheets, chunk_size):
+        chosen = dict((sheet[0], [u''] * len(questions)) for sheet in chunk)
+        scores = dict((sheet[0], 0) for sheet in chunk)
+        qs = MultiChoiceAnswer.objects.filter(
+            answer_sheet__in=chosen.keys()).order_by()
+        for sheet_id, question_id, option_text, is_correct in qs.values_list(
+                'answer_sheet', 'question', 'chosen_option__option_text',
+                'chosen_option__is_correct_option'):
+            # skip answers to questions removed since the snapshot was made
+            if question_id not in columns:
+                continue
+            chosen[sheet_id][columns[question_id]] = option_text
+            if is_correct:
+                scores[sheet_id] += 1
+
+        mobile_numbers = get_mobile_numbers(
+            set(sheet[2] for sheet in chunk))
+        for (sheet_id, questionnaire_id, user_id, username, title,
+                date_created, status) in chunk:
+            msisdn = mobile_numbers.get(user_id)
+            if msisdn is None:
+                msisdn = u'Unknown'
+            yield [username, msisdn, "%s" % date_created,
+                   STATUS_TEXT.get(status, 'Unknown'),
+                   "%s" % scores[sheet_id]] + chosen[sheet_id]
+
+
+def build_answer_matrix(questionnaire_id, sheets=None, chunk_size=CHUNK_SIZE):
+    """ Build the columnar arrays of the answers to a questionnaire in a
+        single pass over its sheets, for analysis with numpy. Each sheet is
+        a row, each question a column in question order:
+
+        - user_ids, sheet_ids and statuses: an integer per sheet.
+        - chosen_options: the chosen option id for each sheet and question,
+          -1 for unanswered questions.
+        - correct: True where the chosen option is correct.
+        - question_ids and question_texts: the question of each column.
+        - option_ids, option_texts and option_question_ids: a lookup table
+          of the options.
+
+        Requires numpy.
+    """
+    snapshot = get_snapshot(questionnaire_id)
+    questions = snapshot.questions
+    columns = dict((the_question.pk, idx)
+                   for idx, the_question in enumerate(questions))
+    options = [(option, the_question.pk) for the_question in questions
+               for option in the_question.options]
+
+    if sheets is None:
+        sheets = AnswerSheet.objects.all()
+    sheets = sheets.filter(questionnaire=questionnaire_id)
+    chunks = []
+    for chunk in iterate_sheet_chunks(sheets, chunk_size):
+        rows = dict((sheet[0], idx) for idx, sheet in enumerate(chunk))
+        chosen = numpy.empty((len(chunk), len(questions)), dtype=numpy.int64)
+        chosen.fill(-1)
+        correct = numpy.zeros((len(chunk), len(questions)), dtype=numpy.bool_)
+        qs = MultiChoiceAnswer.objects.filter(
+            answer_sheet__in=rows.keys()).order_by()
+        for sheet_id, question_id, option_id, is_correct in qs.values_list(
+                'answer_sheet', 'question', 'chosen_option',
+                'chosen_option__is_correct_option'):
+            # skip answers to questions removed since the snapshot was made
+            if question_id not in columns:
+                continue
+            chosen[rows[sheet_id], columns[question_id]] = option_id
+            correct[rows[sheet_id], columns[question_id]] = is_correct
+        chunks.append((
+            numpy.array([sheet[2] for sheet in chunk], dtype=numpy.int64),
+            numpy.array([sheet[0] for sheet in chunk], dtype=numpy.int64),
+            numpy.array([sheet[6] for sheet in chunk], dtype=numpy.int8),
+            chosen, correct))
+
+    if chunks:
+        user_ids, sheet_ids, statuses, chosen, correct = [
+            numpy.concatenate(arrays) for arrays in zip(*chunks)]
+    else:
+        user_ids = numpy.zeros(0, dtype=numpy.int64)
+        sheet_ids = numpy.zeros(0, dtype=numpy.int64)
+        statuses = numpy.zeros(0, dtype=numpy.int8)
+        chosen = numpy.zeros((0, len(questions)), dtype=numpy.int64)
+        correct = numpy.zeros((0, len(questions)), dtype=numpy.bool_)
+
+    return {
+        'user_ids': user_ids,
+        'sheet_ids': sheet_ids,
+        'statuses': statuses,
+        'chosen_options': chosen,
+        'correct': correct,
+        'question_ids': numpy.array(
+            [the_question.pk for the_question in questions],
+            dtype=numpy.int64),
+        'question_texts': numpy.array(
+            [unicode(the_question.question_text)
+             for the_question in questions],
+            dtype=numpy.unicode_),
+        'option_ids': numpy.array(
+            [option.pk for option, question_id in options],
+            dtype=numpy.int64),
+        'option_texts': numpy.array(
+            [unicode(option.option_text) for option, question_id in options],
+            dtype=numpy.unicode_),
+        'option_question_ids': numpy.array(
+            [question_id for option, question_id in options],
+            dtype=numpy.int64),
+    }
+
+
+def write_answer_matrix(filename, questionnaire_id, sheets=None,
+                        chunk_size=CHUNK_SIZE):
+    """ Write the answer matrix of a questionnaire to a compressed .npz file,
+        which is renamed to filename once complete. Returns the number of
+        sheets written.
+    """
+    arrays = build_answer_matrix(questionnaire_id, sheets, chunk_size)
+    tmp_filename = '%s.tmp' % filename
+    with open(tmp_filename, 'wb') as fp:
+        numpy.savez_compressed(fp, **arrays)
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.rename(tmp_filename, filename)
+    return len(arrays['sheet_ids'])
+
+
+def write_wide_csv(writer, questionnaire_id, sheets=None,
+                   chunk_size=CHUNK_SIZE):
+    """ Write the wide format export of a questionnaire with a csv writer.
+        Returns the number of sheets written.
+    """
+    rows = iterate_wide_rows(questionnaire_id, sheets, chunk_size)
+    writer.writerow(rows.next())
+    written = 0
+    for row in rows:
+        writer.writerow(row)
+        written += 1
+    return written
+
+
+def write_csv(writer, sheets=None, chunk_size=CHUNK_SIZE, after=None,
+              checkpoint=None):
+    """ Write the header line and the rows of the sheets with a csv writer.
+        Returns the number of sheets written.
+
+        With after, the export continues after that (questionnaire id, user
+        id) sheet, without a header line. checkpoint is called with the last
+        sheet and the number of sheets written after each chunk.
+    """
+    if after is None:
+        writer.writerow(header_row(get_max_answers(sheets)))
+    written = 0
+    for chunk in iterate_sheet_chunks(sheets, chunk_size, after):
+        for row in chunk_rows(chunk):
+            writer.writerow(row)
+            written += 1
+        if checkpoint is not None:
+            checkpoint(chunk[-1], written)
+    return written
+
+
+class LineBuffer(object):
+    """ A file-like object that keeps the data written to it until it is
+        read.
+    """
+
+    def __init__(self):
+        self.data = []
+
+    def write(self, data):
+        self.data.append(data)
+
+    def read(self):
+        data = ''.join(self.data)
+        self.data = []
+        return data
+
+
+def stream_csv(sheets=None, chunk_size=CHUNK_SIZE):
+    """ Generate the export of the sheets in the format of write_csv, as
+        encoded CSV text for a streaming response, a chunk of sheets at a
+        time.
+
+        The response is only consumed after request_finished closed the
+        request's database connection, so the connection the export opens is
+        closed once it is done. The response status was sent by the time a
+        query fails, so a failure ends the file with STREAM_ERROR_ROW before
+        the error is raised.
+    """
+    outfile = LineBuffer()
+    writer = UnicodeWriter(outfile)
+    try:
+        writer.writerow(header_row(get_max_answers(sheets)))
+        for idx, row in enumerate(iterate_rows(sheets, chunk_size)):
+            writer.writerow(row)
+            if (idx + 1) % chunk_size == 0:
+                yield outfile.read()
+    except Exception:
+        # the generator is suspended by the yield, so keep the error to
+        # raise it afterwards
+        exc_info = sys.exc_info()
+        writer.writerow(STREAM_ERROR_ROW)
+        yield outfile.read()
+        raise exc_info[0], exc_info[1], exc_info[2]
+    finally:
+        connection.close()
+    yield outfile.read()
+
+
+def updated_since(since):
+    """ Return the sheets whose answers changed at or after the given time.
+    """
+    return AnswerSheet.objects.filter(date_last_updated__gte=since)
+
+
+def read_watermark(path):
+    """ Return the time stored in the watermark file, or None if there is no
+        watermark yet. Sheets updated since WATERMARK_MARGIN before this time
+        are exported by the next incremental run.
+    """
+    try:
+        with open(path) as fp:
+            value = fp.read().strip()
+    except IOError:
+        return None
+    return datetime.datetime.strptime(value, WATERMARK_FORMAT)
+
+
+def replace_file(path, data):
+    """ Replace the contents of a small file atomically, so it always holds
+        either the old or the new data.
+    """
+    tmp_path = '%s.tmp' % path
+    with open(tmp_path, 'w') as fp:
+        fp.write(data)
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.rename(tmp_path, path)
+
+
+def write_watermark(path, value):
+    """ Store a time in the watermark file.
+    """
+    replace_file(path, value.strftime(WATERMARK_FORMAT))
+
+
+def read_checkpoint(path):
+    """ Return the checkpoint dictionary stored in the file, or None if there
+        is no checkpoint.
+    """
+    try:
+        with open(path) as fp:
+            checkpoint = json.load(fp)
+    except IOError:
+        return None
+    for key in ('since', 'started'):
+        if checkpoint[key] is not None:
+            checkpoint[key] = datetime.datetime.strptime(checkpoint[key],
+                                                         WATERMARK_FORMAT)
+    return checkpoint
+
+
+def write_checkpoint(path, checkpoint):
+    """ Store a checkpoint dictionary in the file. The times in it are
+        stored in the watermark format.
+    """
+    checkpoint = dict(checkpoint)
+    for key in ('since', 'started'):
+        if checkpoint[key] is not None:
+            checkpoint[key] = checkpoint[key].strftime(WATERMARK_FORMAT)
+    replace_file(path, json.dumps(checkpoint))
+
+
+class ChecksumFile(object):
+    """ Wraps a file, keeping a checksum and the size of the data written to
+        it.
+    """
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.checksum = hashlib.sha1()
+        self.size = 0
+
+    def write(self, data):
+        self.checksum.update(data)
+        self.size += len(data)
+        self.fp.write(data)
+
+    def flush(self):
+        self.fp.flush()
+
+    def hexdigest(self):
+        return self.checksum.hexdigest()
+
+
+class AtomicFile(object):
+    """ An output file that is written under a temporary name, optionally
+        gzip compressed, and renamed to its final name once it is complete
+        and synced to disk. Jobs picking up the file never see it half
+        written. The checksum and size are those of the file on disk.
+
+        An unfinished file can be continued from the offset returned by
+        checkpoint, the checksum then only covers the data written since.
+    """
+
+    def __init__(self, filename, compress=False, offset=None):
+        self.filename = filename
+        self.tmp_filename = '%s.tmp' % filename
+        if offset is None:
+            self.raw = open(self.tmp_filename, 'wb', BUFFER_SIZE)
+        else:
+            # continue an unfinished file from a checkpoint
+            self.raw = open(self.tmp_filename, 'r+b', BUFFER_SIZE)
+            self.raw.truncate(offset)
+            self.raw.seek(offset)
+        self.outfile = ChecksumFile(self.raw)
+        self.outfile.size = offset or 0
+        self.compress = compress
+        self.fp = self.open_member()
+
+    def open_member(self):
+        if not self.compress:
+            return self.outfile
+        # the name stored in the gzip header is that of the contents
+        name = os.path.basename(self.filename)
+        if name.endswith('.gz'):
+            name = name[:-len('.gz')]
+        return gzip.GzipFile(filename=name, mode='wb', fileobj=self.outfile)
+
+    def checkpoint(self):
+        """ Sync the data written so far to disk, and return the size of the
+            file, from which it can be continued. A compressed file ends its
+            gzip member, and continues in a new member.
+        """
+        if self.compress:
+            self.fp.close()
+        offset = self.outfile.size
+        self.raw.flush()
+        os.fsync(self.raw.fileno())
+        self.fp = self.open_member()
+        return offset
+
+    def write(self, data):
+        self.fp.write(data)
+
+    @property
+    def size(self):
+        return self.outfile.size
+
+    def hexdigest(self):
+        return self.outfile.hexdigest()
+
+    def close(self):
+        """ Finish the file, and publish it under its final name.
+        """
+        if self.compress:
+            self.fp.close()
+        self.raw.flush()
+        os.fsync(self.raw.fileno())
+        self.raw.close()
+        os.rename(self.tmp_filename, self.filename)
+
+    def discard(self):
+        """ Remove the unfinished file.
+        """
+        self.raw.close()
+        os.remove(self.tmp_filename)
+
+
+def write_file(filename, write, compress=False):
+    """ Write a file atomically by calling write with an AtomicFile, which is
+        discarded if write raises an error. Returns the result of write and
+        the AtomicFile.
+    """
+    outfile = AtomicFile(filename, compress)
+    try:
+        result = write(outfile)
+    except Exception:
+        outfile.discard()
+        raise
+    outfile.close()
+    return result, outfile
+
+
+def export_questionnaire(task):
+    """ Write the sheets of one questionnaire to a CSV file. The task is a
+        (questionnaire id, file name, since, chunk size, wide, compress)
+        tuple, since being None to export all the sheets, wide selecting the
+        format with a column per question and compress gzipping the file.
+        Returns the questionnaire id, file name, number of rows, checksum and
+        size of the file.
+    """
+    questionnaire_id, filename, since, chunk_size, wide, compress = task
+    sheets = AnswerSheet.objects.filter(questionnaire=questionnaire_id)
+    if since is not None:
+        sheets = sheets.filter(date_last_updated__gte=since)
+
+    def write(outfile):
+        if wide:
+            return write_wide_csv(UnicodeWriter(outfile), questionnaire_id,
+                                  sheets, chunk_size)
+        return write_csv(UnicodeWriter(outfile), sheets, chunk_size)
+
+    rows, outfile = write_file(filename, write, compress)
+    return questionnaire_id, filename, rows, outfile.hexdigest(), outfile.size
+
+
+def export_questionnaire_worker(task):
+    """ Run export_questionnaire in a pool process, which opens its own
+        database connection and closes it when done.
+    """
+    try:
+        return export_questionnaire(task)
+    finally:
+        connection.close()
+
+
+def shard_file_name(filename, suffix):
+    root, ext = os.path.splitext(filename)
+    return '%s_%s%s' % (root, suffix, ext)
+
+
+def export_answer_matrices(filename, sheets=None, chunk_size=CHUNK_SIZE):
+    """ Write the answer matrix of each questionnaire with sheets to its own
+        .npz file, named after filename. Returns the (questionnaire id, file
+        name, rows) results.
+    """
+    if sheets is None:
+        sheets = AnswerSheet.objects.all()
+    questionnaire_ids = list(sheets.order_by('questionnaire__id').values_list(
+        'questionnaire', flat=True).distinct())
+    root, ext = os.path.splitext(filename)
+    results = []
+    for questionnaire_id in questionnaire_ids:
+        matrix_file = '%s_%s.npz' % (root, questionnaire_id)
+        rows = write_answer_matrix(matrix_file, questionnaire_id, sheets,
+                                   chunk_size)
+        results.append((questionnaire_id, matrix_file, rows))
+    return results
+
+
+def export_per_questionnaire(filename, sheets=None, since=None,
+                             chunk_size=CHUNK_SIZE, workers=1, wide=False,
+                             compress=False):
+    """ Export the sheets of each questionnaire to its own file, named after
+        filename, using a pool of worker processes. The files get a .gz
+        extension when compressed. A manifest file lists the files with their
+        row counts and checksums. Returns the manifest file name and the
+        (questionnaire id, file name, rows, checksum, size) results.
+    """
+    if sheets is None:
+        sheets = AnswerSheet.objects.all()
+    questionnaire_ids = list(sheets.order_by('questionnaire__id').values_list(
+        'questionnaire', flat=True).distinct())
+    extension = '.gz' if compress else ''
+    tasks = [(questionnaire_id,
+              shard_file_name(filename, questionnaire_id) + extension,
+              since, chunk_size, wide, compress)
+             for questionnaire_id in questionnaire_ids]
+
+    if workers > 1:
+        # the processes must not share the parent's connection
+        connection.close()
+        pool = multiprocessing.Pool(workers)
+        try:
+            results = pool.map(export_questionnaire_worker, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = map(export_questionnaire, tasks)
+
+    titles = dict(Questionnaire.objects.filter(
+        pk__in=questionnaire_ids).values_list('pk', 'title'))
+    manifest = shard_file_name(filename, 'manifest')
+
+    def write(outfile):
+        writer = UnicodeWriter(outfile)
+        writer.writerow(MANIFEST_HEADER)
+        for questionnaire_id, shard, rows, checksum, size in results:
+            writer.writerow([unicode(questionnaire_id),
+                             titles.get(questionnaire_id, u''),
+                             os.path.basename(shard), unicode(rows),
+                             checksum])
+
+    write_file(manifest, write)
+    return manifest, results
@@ -1,8 +1,14 @@
+import copy
+
+from django.utils.datastructures import SortedDict
+from django.utils.safestring import mark_safe
 from django.utils.translation import ugettext_lazy as _
 from django.forms.widgets import RadioSelect
 
 from django import forms
 
+from survey import caching
+
 
 def as_div(form):
     """This formatter arranges label, widget, help text and error messages by
@@ -47,10 +53,24 @@ class SurveyChoiceForm(forms.Form):
 
 
 class SurveyQuestionMixin(object):
-    """ Mixin class that provides a method to update the multiple choice
-        question choices.
+    """ Mixin class that provides methods to update the multiple choice
+        question choices, and to render them with cached html.
     """
-    def update_the_form(self, survey_id, the_question):
+    # the questionnaire content version the questions were loaded for, the
+    # rendered questions are only cached if it is known.
+    content_version = None
+
+    def get_choices(self, the_question):
+        """ Return the options of the question as field choices. The question
+            can be a MultiChoiceQuestion or a question from a questionnaire
+            snapshot.
+        """
+        options = getattr(the_question, 'options', None)
+        if options is None:
+            options = the_question.multichoiceoption_set.all()
+        return [(itm.pk, itm.option_text,) for itm in options]
+
+    def update_the_form(self, survey_id, the_question, content_version=None):
         """ Create the options for the question and store some hidden fields to
             keep track of where we are.
         """
@@ -61,9 +81,73 @@ class SurveyQuestionMixin(object):
         self.fields['question_id'].initial = the_question.pk
         self.fields['question'].widget.label = the_question.question_text
         self.fields['question'].label = the_question.question_text
-        self.fields['question'].choices = [
-            (itm.pk, itm.option_text,)
-            for itm in the_question.multichoiceoption_set.all()]
+        self.fields['question'].choices = self.get_choices(the_question)
+        self.questions = [the_question]
+        self.question_fields = [('question', the_question)]
+        self.content_version = content_version
+
+    def add_the_questions(self, survey_id, questions, content_version=None):
+        """ Create a question field with its options for each of the
+            questions, to answer them together.
+        """
+        self.fields['survey_id'].initial = survey_id
+        self.fields['question_ids'].initial = ','.join(
+            str(the_question.pk) for the_question in questions)
+        for the_question in questions:
+            self.fields['question_%s' % the_question.pk] = forms.ChoiceField(
+                widget=RadioSelect,
+                label=the_question.question_text,
+                choices=self.get_choices(the_question))
+        self.questions = list(questions)
+        self.question_fields = [('question_%s' % the_question.pk, the_question)
+                                for the_question in questions]
+        self.content_version = content_version
+
+    def get_answers(self):
+        """ Return the (question id, chosen option id) pairs of a valid form.
+        """
+        if 'question' in self.fields:
+            return [(int(self.cleaned_data['question_id']),
+                     int(self.cleaned_data['question']))]
+        return [(the_question.pk,
+                 int(self.cleaned_data['question_%s' % the_question.pk]))
+                for the_question in self.questions]
+
+    def as_div(self):
+        """ Render the form like as_div. For an unbound form the html of the
+            question fields is cached per question and content version, and
+            only the hidden fields are rendered for each request.
+        """
+        if self.is_bound or self.content_version is None:
+            return as_div(self)
+
+        fragments = caching.get_fragments(
+            self.content_version,
+            [(the_question.pk, name)
+             for name, the_question in self.question_fields])
+        rows = []
+        for name, the_question in self.question_fields:
+            html = fragments.get((the_question.pk, name))
+            if html is None:
+                html = self._render_field(name)
+                caching.set_fragment(self.content_version, the_question.pk,
+                                     name, html)
+            rows.append(html)
+        output = u'\n'.join(rows)
+
+        # insert the hidden fields in the last row, as _html_output does
+        hidden = u''.join(unicode(bf) for bf in self.hidden_fields())
+        row_ender = '</div>'
+        if output.endswith(row_ender):
+            output = output[:-len(row_ender)] + hidden + row_ender
+        else:
+            output += hidden
+        return mark_safe(output)
+
+    def _render_field(self, name):
+        fragment_form = copy.copy(self)
+        fragment_form.fields = SortedDict([(name, self.fields[name])])
+        return unicode(as_div(fragment_form))
 
 
 class SurveyQuestionForm(SurveyQuestionMixin, forms.Form):
@@ -72,6 +156,14 @@ class SurveyQuestionForm(SurveyQuestionMixin, forms.Form):
     """
     survey_id = forms.Field(widget=forms.HiddenInput)
     question_id = forms.Field(widget=forms.HiddenInput)
+    page_token = forms.CharField(widget=forms.HiddenInput, required=False)
     question = forms.ChoiceField(widget=RadioSelect)
 
-    as_div = as_div
+
+class SurveyQuestionsForm(SurveyQuestionMixin, forms.Form):
+    """ Display the options and capture the answers for a page of questions
+        in the survey.
+    """
+    survey_id = forms.Field(widget=forms.HiddenInput)
+    question_ids = forms.Field(widget=forms.HiddenInput)
+    page_token = forms.CharField(widget=forms.HiddenInput, required=False)
@@ -1,19 +1,126 @@
 """ Cron-able script to store a CSV export file of answersheets on disk to be
     emailed to interested recipients.
+
+    With --per-questionnaire a file is written for each questionnaire, by
+    --workers processes, together with a manifest listing the files, their
+    row counts and checksums. --wide writes these files with a column for
+    each question.
+
+    With --incremental only the sheets whose answers changed since the last
+    successful incremental run are exported. Each sheet is written at most
+    once per file, so the daily files can be merged by letting a row replace
+    the rows for the same user and questionnaire in earlier files. Sheets
+    updated in the few minutes before the last run started are exported
+    again, so a row can appear in consecutive files, but an answer that was
+    committed while the last run was exporting is never missed.
+
+    With --npz the answers of each questionnaire are written to a compressed
+    numpy .npz file instead, with integer arrays of the users and chosen
+    options, and lookup tables of the question and option texts. This
+    requires numpy.
+
+    Files are written to --output-dir, gzip compressed with --gzip, under a
+    temporary name, and only renamed to their final name once complete, so
+    that the mail job never picks up a half written file.
+
+    With --checkpoint the single file export records its progress after each
+    chunk of sheets in --checkpoint-file. An export that was interrupted is
+    continued from its last checkpoint with --resume.
 """
 import datetime
 import logging
+import os
+from optparse import make_option
 
 from snippetscream.csv_serializer import UnicodeWriter
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 
-from survey.models import AnswerSheet
+from survey import export
 
 logger = logging.getLogger('survey_answersheet_csv_export')
 
 
 class Command(BaseCommand):
     help = "Saves askMAMA answersheet results as CSV file"
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size',
+                    action='store',
+                    type='int',
+                    dest='chunk_size',
+                    default=export.CHUNK_SIZE,
+                    help='Number of answer sheets to read at a time.'),
+        make_option('--since',
+                    action='store',
+                    dest='since',
+                    default=None,
+                    help='Only export the sheets updated since this date, '
+                         'as YYYY-MM-DD or YYYY-MM-DD HH:MM:SS.'),
+        make_option('--incremental',
+                    action='store_true',
+                    dest='incremental',
+                    default=False,
+                    help='Only export the sheets updated since the last '
+                         'incremental export.'),
+        make_option('--watermark-file',
+                    action='store',
+                    dest='watermark_file',
+                    default='askMAMA_Survey_Answers.watermark',
+                    help='File storing the time of the last incremental '
+                         'export.'),
+        make_option('--per-questionnaire',
+                    action='store_true',
+                    dest='per_questionnaire',
+                    default=False,
+                    help='Write a file for each questionnaire.'),
+        make_option('--workers',
+                    action='store',
+                    type='int',
+                    dest='workers',
+                    default=1,
+                    help='Number of processes writing the questionnaire '
+                         'files.'),
+        make_option('--wide',
+                    action='store_true',
+                    dest='wide',
+                    default=False,
+                    help='Write a file for each questionnaire, with a column '
+                         'for each question.'),
+        make_option('--gzip',
+                    action='store_true',
+                    dest='gzip',
+                    default=False,
+                    help='Compress the files with gzip.'),
+        make_option('--output-dir',
+                    action='store',
+                    dest='output_dir',
+                    default='',
+                    help='Directory to write the files to.'),
+        make_option('--npz',
+                    action='store_true',
+                    dest='npz',
+                    default=False,
+                    help='Write a numpy .npz answer matrix for each '
+                         'questionnaire.'),
+        make_option('--checkpoint',
+                    action='store_true',
+                    dest='checkpoint',
+                    default=False,
+                    help='Record the progress of the export, so that it can '
+                         'be resumed.'),
+        make_option('--checkpoint-file',
+                    action='store',
+                    dest='checkpoint_file',
+                    default='askMAMA_Survey_Answers.checkpoint',
+                    help='File storing the progress of the export.'),
+        make_option('--resume',
+                    action='store_true',
+                    dest='resume',
+                    default=False,
+                    help='Continue an interrupted export from its last '
+                         'checkpoint.'),
+    )
+
+    compress = False
 
     def generate_file_name(self):
         now = datetime.datetime.now()
@@ -21,52 +128,175 @@ class Command(BaseCommand):
         filename = "askMAMA_Survey_Answers_%s.csv" % (filedate)
         return filename
 
-    def get_file(self, filename):
-        return open(filename, 'wt')
+    def get_file(self, filename, offset=None):
+        return export.AtomicFile(filename, self.compress, offset)
 
     def close_file(self, fp):
         return fp.close()
 
-    def handle(self, *args, **options):
-        # generate a name for the CSV file
-
-        # determine the maximum answers to display per sheet
-        max_answers = AnswerSheet.objects.get_max_answers()
-
-        # open the output file
-        filename = self.generate_file_name()
-        outfile = self.get_file(filename)
-
-        # create the csv writer
-        writer = UnicodeWriter(outfile)
-
-        # construct the header line
-        header_line = ['User', 'msisdn', 'Questionnaire', 'Date Submitted',
-                       'Status', 'Score']
-        for idx in range(max_answers):
-            header_line.append('Question %s' % (idx+1))
-            header_line.append('Answer %s' % (idx+1))
-
-        # write the header line
-        writer.writerow(header_line)
-
-        # loop through the database data to build the response
-        qs = AnswerSheet.objects.all().order_by(
-            'questionnaire', 'user')
-        for sheet in qs:
-            user = sheet.user
-            msisdn = user.profile.mobile_number
-            if msisdn is None:
-                msisdn = u'Unknown'
-            data = [user.username, msisdn,
-                    sheet.questionnaire.title,
-                    "%s" % sheet.date_created,
-                    sheet.get_status_text(),
-                    "%s" % sheet.calculate_score()
-                    ]
-            for answer in sheet.multichoiceanswer_set.all():
-                data.append(answer.question.question_text)
-                data.append(answer.chosen_option.option_text)
-            writer.writerow(data)
+    def discard_file(self, fp):
+        return fp.discard()
+
+    def log_summary(self, written, filenames, started):
+        """ Log the number of sheets exported, and the size of the files and
+            the throughput.
+        """
+        seconds = max((datetime.datetime.now() - started).total_seconds(),
+                      0.001)
+        size = sum(os.path.getsize(filename) for filename in filenames
+                   if os.path.exists(filename))
+        logger.info("Exported %s answer sheets, %s bytes in %.1f seconds: "
+                    "%.0f sheets/s, %.1f KB/s", written, size, seconds,
+                    written / seconds, size / 1024.0 / seconds)
+
+    def write_with_checkpoints(self, filename, sheets, chunk_size,
+                               checkpoint_file, checkpoint):
+        """ Write the export, storing a checkpoint with the file offset and
+            the last sheet exported after each chunk. The export continues
+            from the checkpoint if it has a file offset. Returns the total
+            number of sheets written.
+        """
+        after = None
+        if checkpoint.get('offset') is None:
+            outfile = self.get_file(filename)
+            checkpoint.update(offset=0, rows=0, questionnaire=None,
+                              user=None, sheet=None)
+            export.write_checkpoint(checkpoint_file, checkpoint)
+        else:
+            outfile = self.get_file(filename, checkpoint['offset'])
+            if checkpoint['questionnaire'] is not None:
+                after = (checkpoint['questionnaire'], checkpoint['user'])
+        rows = checkpoint['rows']
 
+        def save_checkpoint(sheet, written):
+            checkpoint.update(offset=outfile.checkpoint(),
+                              rows=rows + written,
+                              questionnaire=sheet[1],
+                              user=sheet[2],
+                              sheet=sheet[0])
+            export.write_checkpoint(checkpoint_file, checkpoint)
+
+        written = export.write_csv(
+            UnicodeWriter(outfile),
+            sheets=sheets,
+            chunk_size=chunk_size,
+            after=after,
+            checkpoint=save_checkpoint)
         self.close_file(outfile)
+        os.remove(checkpoint_file)
+        return rows + written
+
+    def parse_since(self, value):
+        for date_format in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d'):
+            try:
+                return datetime.datetime.strptime(value, date_format)
+            except ValueError:
+                pass
+        raise CommandError("Invalid --since date: %s" % value)
+
+    def handle(self, *args, **options):
+        if options.get('npz') and export.numpy is None:
+            raise CommandError("--npz requires numpy to be installed")
+
+        checkpointing = options.get('checkpoint') or options.get('resume')
+        if checkpointing and (options.get('npz') or options.get('wide') or
+                              options.get('per_questionnaire')):
+            raise CommandError("--checkpoint and --resume only apply to the "
+                               "single file export")
+
+        # determine the sheets to export. The watermark is the time the run
+        # started, so changes made while exporting are included next time.
+        started = run_started = datetime.datetime.now()
+        since = None
+        watermark_file = options.get('watermark_file',
+                                     'askMAMA_Survey_Answers.watermark')
+        checkpoint_file = options.get('checkpoint_file',
+                                      'askMAMA_Survey_Answers.checkpoint')
+        checkpoint = None
+        if options.get('resume'):
+            # continue the export with the sheets it was started with
+            checkpoint = export.read_checkpoint(checkpoint_file)
+            if checkpoint is None:
+                raise CommandError("There is no export to resume in %s" %
+                                   checkpoint_file)
+            started = checkpoint['started']
+            since = checkpoint['since']
+            incremental = checkpoint['incremental']
+        else:
+            incremental = options.get('incremental', False)
+            if options.get('since'):
+                since = self.parse_since(options['since'])
+            elif incremental:
+                since = export.read_watermark(watermark_file)
+                if since is not None:
+                    since -= export.WATERMARK_MARGIN
+        sheets = None
+        if since is not None:
+            sheets = export.updated_since(since)
+
+        self.compress = options.get('gzip', False)
+        filename = os.path.join(options.get('output_dir') or '',
+                                self.generate_file_name())
+        chunk_size = options.get('chunk_size', export.CHUNK_SIZE)
+        if options.get('npz'):
+            results = export.export_answer_matrices(
+                filename,
+                sheets=sheets,
+                chunk_size=chunk_size)
+            if incremental:
+                export.write_watermark(watermark_file, started)
+            self.log_summary(sum(result[2] for result in results),
+                             [result[1] for result in results], started)
+            return
+
+        if options.get('per_questionnaire') or options.get('wide'):
+            manifest, results = export.export_per_questionnaire(
+                filename,
+                sheets=sheets,
+                since=since,
+                chunk_size=chunk_size,
+                workers=options.get('workers', 1),
+                wide=options.get('wide', False),
+                compress=self.compress)
+            if incremental:
+                export.write_watermark(watermark_file, started)
+            logger.info("Exported %s files listed in %s", len(results),
+                        manifest)
+            self.log_summary(sum(result[2] for result in results),
+                             [result[1] for result in results], started)
+            return
+
+        if checkpoint is not None:
+            filename = checkpoint['filename']
+            self.compress = checkpoint['gzip']
+        elif self.compress:
+            filename += '.gz'
+
+        if checkpointing:
+            if checkpoint is None:
+                checkpoint = {'filename': filename, 'gzip': self.compress,
+                              'since': since, 'started': started,
+                              'incremental': incremental}
+            written = self.write_with_checkpoints(
+                filename, sheets, chunk_size, checkpoint_file, checkpoint)
+        else:
+            # open the output file
+            outfile = self.get_file(filename)
+
+            # create the csv writer, and stream the answer sheets to it
+            writer = UnicodeWriter(outfile)
+            try:
+                written = export.write_csv(
+                    writer,
+                    sheets=sheets,
+                    chunk_size=chunk_size)
+            except Exception:
+                self.discard_file(outfile)
+                raise
+
+            self.close_file(outfile)
+
+        if incremental:
+            export.write_watermark(watermark_file, started)
+        logger.info("Exported %s answer sheets to %s", written, filename)
+        self.log_summary(written, [filename], run_started)
@@ -0,0 +1,32 @@
+""" Cron-able script to store the buffered answers on their answer sheets.
+    Run it every minute or so when the SURVEY_BUFFER_ANSWERS setting is
+    enabled. A run that starts while another is flushing does nothing.
+"""
+import logging
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from survey.models import BufferedAnswer
+
+logger = logging.getLogger('survey_flush_answers')
+
+
+class Command(BaseCommand):
+    help = "Stores the buffered survey answers on their answer sheets."
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size',
+                    action='store',
+                    type='int',
+                    dest='batch_size',
+                    default=1000,
+                    help='Number of answers to store at a time.'),
+    )
+
+    def handle(self, *args, **options):
+        flushed = BufferedAnswer.objects.flush(
+            batch_size=options.get('batch_size', 1000))
+        if flushed is None:
+            logger.info("Another flush is running, nothing flushed")
+        else:
+            logger.info("Flushed %s buffered answers", flushed)
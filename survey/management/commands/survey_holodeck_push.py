@@ -26,6 +26,10 @@ class Command(BaseCommand):
         client = Client(server=settings.HOLODECK_URL)
         now = datetime.datetime.now()
 
+        # count the users per status for all the questionnaires at once
+        status_counts = Questionnaire.objects.status_counts(users,
+                                                            questionnaires)
+
         for questionnaire in questionnaires:
             # check if we have holodeck keys for the questionnaire
             pending_key = self._get_holodeck_key(
@@ -43,17 +47,11 @@ class Command(BaseCommand):
 
             # collect the stats for the questionnaire
             if pending_key or completed_key or incomplete_key or rejected_key:
-                pending = incomplete = completed = rejected = 0
-                for user in users:
-                    status = questionnaire.get_status(user)
-                    if status == constants.QUESTIONNAIRE_PENDING:
-                        pending += 1
-                    elif status == constants.QUESTIONNAIRE_REJECTED:
-                        rejected += 1
-                    elif status == constants.QUESTIONNAIRE_INCOMPLETE:
-                        incomplete += 1
-                    elif status == constants.QUESTIONNAIRE_COMPLETED:
-                        completed += 1
+                counts = status_counts[questionnaire.pk]
+                pending = counts[constants.QUESTIONNAIRE_PENDING]
+                rejected = counts[constants.QUESTIONNAIRE_REJECTED]
+                incomplete = counts[constants.QUESTIONNAIRE_INCOMPLETE]
+                completed = counts[constants.QUESTIONNAIRE_COMPLETED]
 
                 # send the pending stats to holodeck
                 if pending_key:
@@ -0,0 +1,33 @@
+""" Cron-able script to rebuild the materialized survey eligibility table.
+    Run it after activating or changing questionnaires when the
+    SURVEY_USE_ELIGIBILITY_TABLE setting is enabled.
+"""
+import logging
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.contrib.auth.models import User
+
+from survey.models import UserSurveyEligibility
+
+logger = logging.getLogger('survey_rebuild_eligibility')
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the survey eligibility of all active users."
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size',
+                    action='store',
+                    type='int',
+                    dest='chunk_size',
+                    default=1000,
+                    help='Number of users to rebuild at a time.'),
+    )
+
+    def handle(self, *args, **options):
+        UserSurveyEligibility.objects.remove_inactive()
+        users = User.objects.filter(is_active=True)
+        rows = UserSurveyEligibility.objects.rebuild(
+            users,
+            chunk_size=options.get('chunk_size', 1000))
+        logger.info("Rebuilt %s survey eligibility rows", rows)
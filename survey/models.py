@@ -1,9 +1,84 @@
-from django.db import models
-from django.db.models import Count
+import datetime
+import logging
+
+from django.conf import settings
+from django.db import connection, models, transaction, IntegrityError
+from django.db.models import Count, F, Max
+from django.db.models.signals import post_save, post_delete
 from django.contrib.auth.models import User
-from django.core.exceptions import ObjectDoesNotExist
+from django.core.exceptions import ObjectDoesNotExist, ValidationError
+
+from survey import caching, constants
+
+logger = logging.getLogger('survey')
+
+
+def use_eligibility_table():
+    """ Determine if eligibility is read from the materialized
+        UserSurveyEligibility table, as enabled by the
+        SURVEY_USE_ELIGIBILITY_TABLE setting.
+    """
+    return getattr(settings, 'SURVEY_USE_ELIGIBILITY_TABLE', False)
+
+
+def use_answer_buffer():
+    """ Determine if submitted answers are buffered in the BufferedAnswer
+        table, to be stored by the survey_flush_answers command, as enabled by
+        the SURVEY_BUFFER_ANSWERS setting.
+    """
+    return getattr(settings, 'SURVEY_BUFFER_ANSWERS', False)
+
+
+def get_profile_model():
+    """ Return the user profile model configured with AUTH_PROFILE_MODULE, or
+        None if there is none.
+    """
+    profile_module = getattr(settings, 'AUTH_PROFILE_MODULE', None)
+    if profile_module:
+        app_label, model_name = profile_module.split('.')
+        return models.get_model(app_label, model_name)
+
+
+def get_declined_user_ids(user_ids, users=None):
+    """ Return the set of ids of the given users who declined surveys. The
+        users are only loaded, unless given, when there is no profile model
+        to query.
+    """
+    profile_model = get_profile_model()
+    if profile_model is not None:
+        return set(profile_model.objects.filter(
+            user__in=user_ids,
+            decline_surveys=True).values_list('user', flat=True))
+
+    if users is None:
+        users = User.objects.filter(pk__in=user_ids)
+    declined = set()
+    for user in users:
+        try:
+            if user.profile.decline_surveys:
+                declined.add(user.pk)
+        except ObjectDoesNotExist:
+            pass
+    return declined
+
 
-from survey import constants
+def iterate_users(users, chunk_size):
+    """ Iterate over a user queryset in chunks, ordered by primary key. Each
+        chunk is a list of users and the set of ids of the users in it who
+        declined surveys.
+    """
+    last_pk = None
+    while True:
+        qs = users.order_by('pk')
+        if last_pk is not None:
+            qs = qs.filter(pk__gt=last_pk)
+        chunk = list(qs[:chunk_size])
+        if not chunk:
+            break
+        last_pk = chunk[-1].pk
+
+        yield chunk, get_declined_user_ids([user.pk for user in chunk],
+                                           chunk)
 
 
 class QuestionnaireManager(models.Manager):
@@ -12,15 +87,102 @@ class QuestionnaireManager(models.Manager):
     """
 
     def questionnaire_for_user(self, user):
-        """ Determine if a questionnaire is available for a given user
+        """ Determine if a questionnaire is available for a given user.
+
+            The statuses and required surveys of all the questionnaires are
+            resolved together by a PrerequisiteResolver, so only the active
+            questionnaires need to be fetched.
         """
         if not user.profile.decline_surveys:
+            if use_eligibility_table():
+                return UserSurveyEligibility.objects.questionnaire_for_user(
+                    user)
+
+            resolver = PrerequisiteResolver.for_user(user)
             qs = self.get_query_set().filter(active=True)
             for itm in qs:
                 # look for a questionnaire with available questions
-                if itm.get_status(user) != constants.QUESTIONNAIRE_COMPLETED and itm.get_required_survey(user):
+                if resolver.get_status(itm.pk) != \
+                        constants.QUESTIONNAIRE_COMPLETED and \
+                        resolver.is_unlocked(itm.pk):
                     return itm
 
+    def status_matrix(self, users, questionnaires, chunk_size=1000):
+        """ Generate a (user id, questionnaire id, status) tuple for every
+            combination of the users and questionnaires querysets, processing
+            the users in chunks. The statuses follow the same rules as the
+            get_status method of the questionnaires' model, so the declined
+            flag is ignored for a ContentQuiz queryset.
+        """
+        questionnaire_ids = list(
+            questionnaires.order_by().values_list('pk', flat=True))
+        check_declined = not issubclass(questionnaires.model, ContentQuiz)
+        if not questionnaire_ids:
+            return
+        for chunk, declined in iterate_users(users, chunk_size):
+            qs = AnswerSheet.objects.filter(
+                user__in=[user.pk for user in chunk],
+                questionnaire__in=questionnaire_ids).order_by()
+            statuses = dict(
+                ((user_id, questionnaire_id), status)
+                for user_id, questionnaire_id, status in qs.values_list(
+                    'user', 'questionnaire', 'status'))
+
+            for user in chunk:
+                for questionnaire_id in questionnaire_ids:
+                    if check_declined and user.pk in declined:
+                        status = constants.QUESTIONNAIRE_REJECTED
+                    else:
+                        status = statuses.get(
+                            (user.pk, questionnaire_id),
+                            constants.QUESTIONNAIRE_PENDING)
+                    yield user.pk, questionnaire_id, status
+
+    def status_counts(self, users, questionnaires, chunk_size=1000):
+        """ Count the users per status for each of the questionnaires, using
+            the same rules as status_matrix. The answer sheets are grouped by
+            status in the database, one chunk of users at a time.
+
+            Returns a dictionary of questionnaire id to a dictionary of
+            status to number of users.
+        """
+        questionnaire_ids = list(
+            questionnaires.order_by().values_list('pk', flat=True))
+        check_declined = not issubclass(questionnaires.model, ContentQuiz)
+        result = dict(
+            (questionnaire_id,
+             dict((status, 0) for status, title in
+                  constants.QUESTIONNAIRE_STATUSES))
+            for questionnaire_id in questionnaire_ids)
+        if not questionnaire_ids:
+            return result
+
+        for chunk, declined in iterate_users(users, chunk_size):
+            user_ids = [user.pk for user in chunk]
+            if check_declined:
+                rejected = len(declined)
+                user_ids = [pk for pk in user_ids if pk not in declined]
+            else:
+                rejected = 0
+
+            for counts in result.values():
+                counts[constants.QUESTIONNAIRE_PENDING] += len(user_ids)
+                counts[constants.QUESTIONNAIRE_REJECTED] += rejected
+            if not user_ids:
+                continue
+
+            qs = AnswerSheet.objects.filter(
+                user__in=user_ids,
+                questionnaire__in=questionnaire_ids).order_by()
+            qs = qs.values_list('questionnaire', 'status').annotate(
+                count=Count('id'))
+            for questionnaire_id, status, count in qs:
+                # users with a sheet are not pending by default
+                counts = result[questionnaire_id]
+                counts[constants.QUESTIONNAIRE_PENDING] -= count
+                counts[status] += count
+        return result
+
 
 class Questionnaire(models.Model):
     """ Defines an available Questionnaire
@@ -32,6 +194,9 @@ class Questionnaire(models.Model):
     created_by = models.ForeignKey(User, blank=False)
     active = models.BooleanField(default=False)
     target_survey_users = models.ForeignKey("self",blank=True,null=True)
+    questions_per_page = models.PositiveSmallIntegerField(
+        default=1,
+        help_text='The number of questions shown on each page of the survey.')
 
     objects = QuestionnaireManager()
 
@@ -41,38 +206,43 @@ class Questionnaire(models.Model):
     class Meta:
         ordering = ('date_created',)
 
+    def clean(self):
+        """ Prevent the required surveys from forming a cycle.
+        """
+        if self.pk is not None and self.target_survey_users_id is not None:
+            prerequisites = PrerequisiteResolver.load_prerequisites()
+            prerequisites[self.pk] = self.target_survey_users_id
+            if find_cycle(prerequisites, self.pk):
+                raise ValidationError(
+                    'The required survey may not depend on this survey.')
+
     def get_required_survey(self, user):
-        if self.target_survey_users is None:
+        if self.target_survey_users_id is None:
             return True
         else:
             if user.is_anonymous():
                 return False
             else:
-                required_survey = self.target_survey_users.get_status(user=user)
+                resolver = PrerequisiteResolver.for_user(user)
+                required_survey = resolver.get_status(
+                    self.target_survey_users_id)
                 if required_survey == constants.QUESTIONNAIRE_COMPLETED:
                     return True
                 else:
                     return False
 
     def get_next_question_for_user(self, user):
-        """ Retrieve the next unanswered question in the questionnaire
+        """ Retrieve the next unanswered question in the questionnaire, using
+            a single query.
         """
+        answered = MultiChoiceAnswer.objects.filter(
+            answer_sheet__questionnaire=self,
+            answer_sheet__user=user.pk).order_by().values('question')
+        qs = self.multichoicequestion_set.exclude(pk__in=answered)
         try:
-            # get the matching answersheet for the user.
-            answersheet = self.answersheet_set.get(user=user)
-
-            # if the sheet has no answers yet, return the first question
-            if not answersheet.multichoiceanswer_set.exists():
-                return self.multichoicequestion_set.all()[0]
-            else:
-                # find and return the first question without an answer
-                for question in self.multichoicequestion_set.all():
-                    if not answersheet.multichoiceanswer_set.filter(
-                            question=question).exists():
-                        return question
-        except AnswerSheet.DoesNotExist:
-            # no answer sheet yet
-            return self.multichoicequestion_set.all()[0]
+            return qs.order_by('question_order')[0]
+        except IndexError:
+            return None
 
     def get_status(self, user):
         try:
@@ -80,12 +250,8 @@ class Questionnaire(models.Model):
                 return constants.QUESTIONNAIRE_REJECTED
         except ObjectDoesNotExist:
             pass
-        qs = self.answersheet_set.filter(user=user)
-        if not qs.exists():
-            return constants.QUESTIONNAIRE_PENDING
-        else:
-            return qs[0].get_status()
-        return constants.QUESTIONNAIRE_PENDING
+        statuses = AnswerSheet.objects.status_map(user)
+        return statuses.get(self.pk, constants.QUESTIONNAIRE_PENDING)
 
     def number_of_questions(self):
         return self.multichoicequestion_set.count()
@@ -99,9 +265,17 @@ class ContentQuizManager(models.Manager):
     def home_page_quizzes(self, user):
         """ Return content linked quizzes that needs to show on the home page.
         """
+        if use_eligibility_table() and user.is_authenticated():
+            return UserSurveyEligibility.objects.home_page_quizzes(user)
+
+        resolver = PrerequisiteResolver.for_user(user)
         qs = self.get_query_set().filter(active=True, show_on_home_page=True)
+        # content linked quizzes don't check the declined flag for their own
+        # status, but do for their required survey.
         return [itm for itm in qs
-                if itm.get_status(user) != constants.QUESTIONNAIRE_COMPLETED and itm.get_required_survey(user)]
+                if resolver.get_sheet_status(itm.pk) !=
+                constants.QUESTIONNAIRE_COMPLETED and
+                resolver.is_unlocked(itm.pk)]
 
 
 class ContentQuiz(Questionnaire):
@@ -121,12 +295,8 @@ class ContentQuiz(Questionnaire):
         """ Check the status of the content linked quiz for the user. Don't
             check the declined flag in the user profile.
         """
-        qs = self.answersheet_set.filter(user=user.id)
-        if not qs.exists():
-            return constants.QUESTIONNAIRE_PENDING
-        else:
-            return qs[0].get_status()
-        return constants.QUESTIONNAIRE_PENDING
+        statuses = AnswerSheet.objects.status_map(user)
+        return statuses.get(self.pk, constants.QUESTIONNAIRE_PENDING)
 
 
 class ContentQuizToPost(models.Model):
@@ -191,21 +361,267 @@ class MultiChoiceOption(models.Model):
         ordering = ('option_order',)
 
 
+def find_cycle(prerequisites, questionnaire_id):
+    """ Follow the chain of required surveys from a questionnaire, and return
+        the list of questionnaire ids forming a cycle, or None if the chain
+        ends.
+    """
+    chain = [questionnaire_id]
+    current = prerequisites.get(questionnaire_id)
+    while current is not None:
+        if current in chain:
+            return chain[chain.index(current):] + [current]
+        chain.append(current)
+        current = prerequisites.get(current)
+    return None
+
+
+class PrerequisiteResolver(object):
+    """ Resolves the status and the required survey of all questionnaires for
+        a user at once.
+
+        The required survey of every questionnaire is loaded with a single
+        query and cached until the questionnaires change, and the statuses
+        come from the user's cached status map, so the depth of a chain of
+        required surveys makes no difference to the cost. Resolvers are
+        memoized on the user object for the duration of the request.
+    """
+
+    def __init__(self, prerequisites, statuses, declined=False,
+                 anonymous=False):
+        self.generation = caching.local_generation
+        self.prerequisites = prerequisites
+        self.statuses = statuses
+        self.declined = declined
+        self.anonymous = anonymous
+
+    @classmethod
+    def for_user(cls, user):
+        resolver = getattr(user, '_survey_resolver', None)
+        if resolver is None or \
+                resolver.generation != caching.local_generation:
+            declined = False
+            if not user.is_anonymous():
+                try:
+                    declined = user.profile.decline_surveys
+                except ObjectDoesNotExist:
+                    pass
+            resolver = cls(cls.load_prerequisites(),
+                           AnswerSheet.objects.status_map(user),
+                           declined=declined,
+                           anonymous=user.is_anonymous())
+            user._survey_resolver = resolver
+        return resolver
+
+    @staticmethod
+    def load_prerequisites():
+        """ Return a dictionary of questionnaire id to required questionnaire
+            id, for all the questionnaires with a required survey.
+        """
+        version, prerequisites = caching.get_prerequisites()
+        if prerequisites is None:
+            qs = Questionnaire.objects.filter(
+                target_survey_users__isnull=False).order_by()
+            prerequisites = dict(qs.values_list('id', 'target_survey_users'))
+            for questionnaire_id in prerequisites:
+                cycle = find_cycle(prerequisites, questionnaire_id)
+                if cycle:
+                    logger.error('Required surveys form a cycle: %s',
+                                 ' -> '.join(str(itm) for itm in cycle))
+            caching.set_prerequisites(version, prerequisites)
+        return dict(prerequisites)
+
+    def get_sheet_status(self, questionnaire_id):
+        """ The status of the user's answer sheet, as used by
+            ContentQuiz.get_status.
+        """
+        return self.statuses.get(questionnaire_id,
+                                 constants.QUESTIONNAIRE_PENDING)
+
+    def get_status(self, questionnaire_id):
+        """ The status of the questionnaire, as used by
+            Questionnaire.get_status.
+        """
+        if self.declined:
+            return constants.QUESTIONNAIRE_REJECTED
+        return self.get_sheet_status(questionnaire_id)
+
+    def is_unlocked(self, questionnaire_id):
+        """ Determine if the required survey of the questionnaire, if any, was
+            completed by the user.
+        """
+        required_id = self.prerequisites.get(questionnaire_id)
+        if required_id is None:
+            return True
+        if self.anonymous:
+            return False
+        return self.get_status(required_id) == \
+            constants.QUESTIONNAIRE_COMPLETED
+
+    def is_eligible(self, questionnaire_id):
+        """ Determine if the questionnaire should be offered to the user,
+            ignoring the declined flag for the questionnaire itself.
+        """
+        return self.get_sheet_status(questionnaire_id) != \
+            constants.QUESTIONNAIRE_COMPLETED and \
+            self.is_unlocked(questionnaire_id)
+
+    def unlocked_map(self, questionnaire_ids):
+        """ Return a dictionary of questionnaire id to whether it is unlocked
+            for the user.
+        """
+        return dict((questionnaire_id, self.is_unlocked(questionnaire_id))
+                    for questionnaire_id in questionnaire_ids)
+
+
+def calculate_status(number_of_questions, number_of_questions_answered):
+    """ Determine the participation status for an answer sheet, given the
+        number of questions in the questionnaire and the number of questions
+        answered on the sheet.
+    """
+    # If an answersheet exists, but no answers have been recorded, the
+    # status is pending.
+    if number_of_questions_answered == 0:
+        return constants.QUESTIONNAIRE_PENDING
+
+    # If an answersheet exists, with less answers than questions, the
+    # status is incomplete.
+    if (number_of_questions_answered > 0) and \
+            (number_of_questions_answered < number_of_questions):
+        return constants.QUESTIONNAIRE_INCOMPLETE
+
+    # if the number of answers matches the number of questions, the status
+    # is complete.
+    if number_of_questions_answered == number_of_questions:
+        return constants.QUESTIONNAIRE_COMPLETED
+
+    # default status is pending
+    return constants.QUESTIONNAIRE_PENDING
+
+
 class AnswerSheetManager(models.Manager):
     """ Model manager for answer sheet model.
     """
 
+    def status_map(self, user):
+        """ Return a dictionary of questionnaire id to status for all of the
+            user's answer sheets. The dictionary is cached per user, and
+            fetched with a single query on a cache miss.
+        """
+        if user.is_anonymous():
+            return {}
+        version, statuses = caching.get_status_map(user.pk)
+        if statuses is None:
+            qs = self.get_query_set().filter(user=user).order_by()
+            statuses = dict(qs.values_list('questionnaire', 'status'))
+            if use_answer_buffer():
+                BufferedAnswer.objects.merge_statuses({user.pk: statuses})
+            caching.set_status_map(user.pk, version, statuses)
+        return statuses
+
+    def update_answers_count(self, sheet_id, delta):
+        """ Atomically adjust the stored answer count of a sheet after an
+            answer was added or removed, and update its status to match.
+            Returns the new answer count, status and completion date.
+        """
+        qs = self.get_query_set().filter(pk=sheet_id)
+        qs.update(answers_count=F('answers_count') + delta,
+                  date_last_updated=datetime.datetime.now())
+
+        # concurrent answers may change the count again before it is read
+        # back, see below.
+        qs = qs.order_by().values_list('answers_count', 'status',
+                                       'completed_at', 'user',
+                                       'questionnaire')
+        qs = qs.annotate(
+            questions=Count('questionnaire__multichoicequestion'))
+        try:
+            (answers_count, old_status, completed_at, user_id,
+             questionnaire_id, questions) = qs[0]
+        except IndexError:
+            # the sheet is being deleted
+            return None
+        caching.bump_sheet_version(user_id, questionnaire_id)
+
+        # the status is only written if the count is still the one read
+        # back, and the status the one it replaces. If another answer
+        # changed the count in the meantime, that answer's update writes the
+        # status for it, and of two updates for the same count only one
+        # writes the status and reports the change.
+        status = calculate_status(questions, answers_count)
+        if status != old_status:
+            if status == constants.QUESTIONNAIRE_COMPLETED:
+                completed_at = datetime.datetime.now()
+            else:
+                completed_at = None
+            updated = self.get_query_set().filter(
+                pk=sheet_id,
+                answers_count=answers_count,
+                status=old_status).update(
+                    status=status,
+                    completed_at=completed_at)
+            if updated:
+                user_changed(user_id, refresh=delta > 0)
+        return answers_count, status, completed_at
+
+    def touch(self, sheet_ids):
+        """ Mark the sheets as updated, after answers on them were changed
+            with update statements.
+        """
+        self.get_query_set().filter(pk__in=sheet_ids).update(
+            date_last_updated=datetime.datetime.now())
+
+    def refresh_status(self, questionnaire_id):
+        """ Update the stored status of all the sheets for a questionnaire
+            after questions were added or removed. The answer count of the
+            sheets stays the same, so this is done with a fixed number of
+            update statements.
+        """
+        questions = MultiChoiceQuestion.objects.filter(
+            questionnaire=questionnaire_id).count()
+        qs = self.get_query_set().filter(questionnaire=questionnaire_id)
+
+        # these mirror the rules in calculate_status
+        qs.filter(answers_count=0).exclude(
+            status=constants.QUESTIONNAIRE_PENDING).update(
+                status=constants.QUESTIONNAIRE_PENDING,
+                completed_at=None)
+        qs.filter(answers_count__gt=0, answers_count__lt=questions).exclude(
+            status=constants.QUESTIONNAIRE_INCOMPLETE).update(
+                status=constants.QUESTIONNAIRE_INCOMPLETE,
+                completed_at=None)
+        qs.filter(answers_count__gt=0, answers_count=questions).exclude(
+            status=constants.QUESTIONNAIRE_COMPLETED).update(
+                status=constants.QUESTIONNAIRE_COMPLETED,
+                completed_at=datetime.datetime.now())
+        qs.filter(answers_count__gt=questions).exclude(
+            status=constants.QUESTIONNAIRE_PENDING).update(
+                status=constants.QUESTIONNAIRE_PENDING,
+                completed_at=None)
+
     def get_max_answers(self):
         """ Used to get the maximum number of questions answered across all
             sheets, for correctly setting the headings row for the CSV export
-            file.
-        """
-        result = 0
-        qs = self.get_query_set().values('id')
-        if qs:
-            qs = qs.annotate(answers=Count('multichoiceanswer'))
-            qs = qs.order_by('-answers')
-            result = list(qs)[0]['answers']
+            file. Reads the stored answer counts with a single aggregate.
+        """
+        result = self.get_query_set().aggregate(
+            answers=Max('answers_count'))['answers']
+        return result or 0
+
+    def score_map(self, sheet_ids):
+        """ Return a dictionary of sheet id to (score, number of answers) for
+            the sheets, counted with a single grouped query.
+        """
+        result = dict((sheet_id, (0, 0)) for sheet_id in sheet_ids)
+        qs = MultiChoiceAnswer.objects.filter(
+            answer_sheet__in=sheet_ids).order_by()
+        qs = qs.values_list('answer_sheet',
+                            'chosen_option__is_correct_option')
+        for sheet_id, is_correct, count in qs.annotate(Count('id')):
+            score, answers = result[sheet_id]
+            if is_correct:
+                score += count
+            result[sheet_id] = (score, answers + count)
         return result
 
 
@@ -216,7 +632,19 @@ class AnswerSheet(models.Model):
     questionnaire = models.ForeignKey(Questionnaire, blank=False)
     user = models.ForeignKey(User, blank=False)
     date_created = models.DateTimeField(auto_now_add=True)
-    date_last_updated = models.DateTimeField(auto_now=True, blank=True)
+    date_last_updated = models.DateTimeField(auto_now=True, blank=True,
+                                             db_index=True)
+
+    # maintained by the MultiChoiceAnswer and MultiChoiceQuestion signal
+    # handlers below.
+    answers_count = models.PositiveIntegerField(default=0, editable=False)
+    status = models.PositiveSmallIntegerField(
+        choices=constants.QUESTIONNAIRE_STATUSES,
+        default=constants.QUESTIONNAIRE_PENDING,
+        db_index=True,
+        editable=False)
+    completed_at = models.DateTimeField(blank=True, null=True,
+                                        editable=False)
 
     objects = AnswerSheetManager()
 
@@ -230,34 +658,13 @@ class AnswerSheet(models.Model):
     def number_of_questions_answered(self):
         """ return the number of answered questions for a user for this sheet
         """
-        # return self.multichoiceanswer_set.filter(answer_sheet=self).count()
-        return self.multichoiceanswer_set.count()
+        return self.answers_count
 
     def get_status(self):
         """ Determine the status of the user's participation in the
             questionnaire.
         """
-        number_of_questions = self.questionnaire.number_of_questions()
-        number_of_questions_answered = self.number_of_questions_answered()
-
-        # If an answersheet exists, but no answers have been recorded, the
-        # status is pending.
-        if number_of_questions_answered == 0:
-            return constants.QUESTIONNAIRE_PENDING
-
-        # If an answersheet exists, with less answers than questions, the
-        # status is incomplete.
-        if (number_of_questions_answered > 0) and \
-                (number_of_questions_answered < number_of_questions):
-            return constants.QUESTIONNAIRE_INCOMPLETE
-
-        # if the number of answers matches the number of questions, the status
-        # is complete.
-        if number_of_questions_answered == number_of_questions:
-            return constants.QUESTIONNAIRE_COMPLETED
-
-        # default status is pending
-        return constants.QUESTIONNAIRE_PENDING
+        return self.status
 
     def get_status_text(self):
         status = self.get_status()
@@ -274,11 +681,82 @@ class AnswerSheet(models.Model):
     def calculate_score(self):
         """ calculate the user's score.
         """
-        score = 0
-        for itm in self.multichoiceanswer_set.all():
-            if itm.chosen_option.is_correct_option:
-                score += 1
-        return score
+        # imported here, the snapshot module depends on the models
+        from survey.snapshot import get_snapshot
+        chosen_option_ids = self.multichoiceanswer_set.values_list(
+            'chosen_option', flat=True)
+        return get_snapshot(self.questionnaire_id).score(chosen_option_ids)
+
+
+class MultiChoiceAnswerManager(models.Manager):
+    """ Model manager for the multiple choice answers.
+    """
+
+    def answer(self, answer_sheet, question_id, chosen_option_id):
+        """ Store the chosen option for a question on an answer sheet. A
+            question that was already answered, for example by a submit that
+            was sent twice, gets its chosen option replaced. Returns whether a
+            new answer was created.
+        """
+        sid = transaction.savepoint()
+        try:
+            self.create(answer_sheet=answer_sheet,
+                        question_id=question_id,
+                        chosen_option_id=chosen_option_id)
+        except IntegrityError:
+            transaction.savepoint_rollback(sid)
+            self.get_query_set().filter(
+                answer_sheet=answer_sheet,
+                question=question_id).update(chosen_option=chosen_option_id)
+            AnswerSheet.objects.touch([answer_sheet.pk])
+            return False
+        transaction.savepoint_commit(sid)
+        return True
+
+    def answered_question_ids(self, user_id, questionnaire_id):
+        """ Return the ids of the questions the user answered, including the
+            buffered answers that were not flushed yet.
+        """
+        question_ids = set(self.get_query_set().filter(
+            answer_sheet__questionnaire=questionnaire_id,
+            answer_sheet__user=user_id).values_list('question', flat=True))
+        if use_answer_buffer():
+            question_ids.update(BufferedAnswer.objects.filter(
+                questionnaire=questionnaire_id,
+                user=user_id).values_list('question', flat=True))
+        return question_ids
+
+    def answer_many(self, answer_sheet, answers):
+        """ Store a list of (question id, chosen option id) pairs for an
+            answer sheet with a single insert. bulk_create sends no signals,
+            so the stored counters of the sheet are updated here. If one of
+            the questions was answered already, the answers are stored one at
+            a time instead. Returns the number of answers created.
+        """
+        if len(answers) == 1:
+            return int(self.answer(answer_sheet, *answers[0]))
+
+        sid = transaction.savepoint()
+        try:
+            self.bulk_create([
+                self.model(answer_sheet=answer_sheet,
+                           question_id=question_id,
+                           chosen_option_id=chosen_option_id)
+                for question_id, chosen_option_id in answers])
+        except IntegrityError:
+            transaction.savepoint_rollback(sid)
+            return len([question_id
+                        for question_id, chosen_option_id in answers
+                        if self.answer(answer_sheet, question_id,
+                                       chosen_option_id)])
+        transaction.savepoint_commit(sid)
+
+        result = AnswerSheet.objects.update_answers_count(answer_sheet.pk,
+                                                          len(answers))
+        if result is not None:
+            (answer_sheet.answers_count, answer_sheet.status,
+             answer_sheet.completed_at) = result
+        return len(answers)
 
 
 class MultiChoiceAnswer(models.Model):
@@ -292,5 +770,465 @@ class MultiChoiceAnswer(models.Model):
         return "%s: %s" % (self.question.question_text,
                            self.chosen_option.option_text)
 
+    objects = MultiChoiceAnswerManager()
+
     class Meta:
         ordering = ('answer_sheet', 'question__question_order',)
+        unique_together = ('answer_sheet', 'question',)
+
+
+class BufferedAnswerManager(models.Manager):
+    """ Model manager for the answers waiting to be flushed.
+    """
+
+    def buffer(self, user_id, questionnaire_id, answers):
+        """ Store a list of (question id, chosen option id) pairs answered
+            by the user with a single insert, without loading or creating the
+            answer sheet.
+        """
+        self.bulk_create([
+            self.model(user_id=user_id,
+                       questionnaire_id=questionnaire_id,
+                       question_id=question_id,
+                       chosen_option_id=chosen_option_id)
+            for question_id, chosen_option_id in answers])
+        caching.bump_sheet_version(user_id, questionnaire_id)
+        user_changed(user_id)
+
+    def merge_statuses(self, statuses):
+        """ Update a dictionary of user id to a dictionary of questionnaire
+            id to status with the statuses the users' sheets will have once
+            their buffered answers are flushed.
+        """
+        buffered = {}
+        qs = self.get_query_set().filter(user__in=statuses.keys()).order_by()
+        for user_id, questionnaire_id, question_id in qs.values_list(
+                'user', 'questionnaire', 'question'):
+            buffered.setdefault((user_id, questionnaire_id), set()).add(
+                question_id)
+        if not buffered:
+            return statuses
+
+        user_ids = set(user_id for user_id, questionnaire_id in buffered)
+        questionnaire_ids = set(
+            questionnaire_id for user_id, questionnaire_id in buffered)
+        answered = set(MultiChoiceAnswer.objects.filter(
+            answer_sheet__user__in=user_ids,
+            question__in=set().union(*buffered.values())).values_list(
+                'answer_sheet__user', 'question'))
+        answers_counts = dict(
+            ((user_id, questionnaire_id), answers_count)
+            for user_id, questionnaire_id, answers_count in
+            AnswerSheet.objects.filter(
+                user__in=user_ids,
+                questionnaire__in=questionnaire_ids).values_list(
+                    'user', 'questionnaire', 'answers_count'))
+        questions = dict(MultiChoiceQuestion.objects.filter(
+            questionnaire__in=questionnaire_ids).order_by().values_list(
+                'questionnaire').annotate(Count('id')))
+
+        for (user_id, questionnaire_id), question_ids in buffered.items():
+            new_answers = len([question_id for question_id in question_ids
+                               if (user_id, question_id) not in answered])
+            statuses[user_id][questionnaire_id] = calculate_status(
+                questions.get(questionnaire_id, 0),
+                answers_counts.get((user_id, questionnaire_id), 0) +
+                new_answers)
+        return statuses
+
+    @transaction.commit_on_success
+    def flush_batch(self, batch_size=1000):
+        """ Move the oldest batch of buffered answers to their answer sheets,
+            creating the sheets that don't exist yet. The last answer given
+            to a question replaces any earlier one. Returns the number of
+            buffered answers flushed.
+        """
+        # lock the batch where the database can, so that a concurrent flush
+        # can't apply the same answers
+        qs = self.get_query_set()
+        if connection.features.has_select_for_update:
+            qs = qs.select_for_update()
+        batch = list(qs.order_by('pk').values_list(
+            'pk', 'user', 'questionnaire', 'question',
+            'chosen_option')[:batch_size])
+        if not batch:
+            return 0
+
+        user_ids = set(row[1] for row in batch)
+        questionnaire_ids = set(row[2] for row in batch)
+
+        def get_sheets():
+            qs = AnswerSheet.objects.filter(
+                user__in=user_ids,
+                questionnaire__in=questionnaire_ids).order_by()
+            return dict(((user_id, questionnaire_id), pk)
+                        for pk, user_id, questionnaire_id in qs.values_list(
+                            'pk', 'user', 'questionnaire'))
+
+        sheets = get_sheets()
+        missing = set((row[1], row[2]) for row in batch) - set(sheets)
+        if missing:
+            AnswerSheet.objects.bulk_create([
+                AnswerSheet(user_id=user_id, questionnaire_id=questionnaire_id)
+                for user_id, questionnaire_id in missing])
+            sheets = get_sheets()
+
+        # the rows are ordered, so the last answer to a question wins
+        chosen = {}
+        for pk, user_id, questionnaire_id, question_id, option_id in batch:
+            chosen[(sheets[(user_id, questionnaire_id)], question_id)] = \
+                option_id
+
+        existing = set(MultiChoiceAnswer.objects.filter(
+            answer_sheet__in=set(sheet_id for sheet_id, question_id in chosen),
+            question__in=set(question_id
+                             for sheet_id, question_id in chosen)).values_list(
+                'answer_sheet', 'question'))
+        new_answers = []
+        added = {}
+        replaced = set()
+        for (sheet_id, question_id), option_id in chosen.items():
+            if (sheet_id, question_id) in existing:
+                MultiChoiceAnswer.objects.filter(
+                    answer_sheet=sheet_id,
+                    question=question_id).update(chosen_option=option_id)
+                replaced.add(sheet_id)
+            else:
+                new_answers.append(MultiChoiceAnswer(
+                    answer_sheet_id=sheet_id,
+                    question_id=question_id,
+                    chosen_option_id=option_id))
+                added[sheet_id] = added.get(sheet_id, 0) + 1
+        MultiChoiceAnswer.objects.bulk_create(new_answers)
+
+        # bulk_create sends no signals, update the sheet counters here
+        for sheet_id, count in added.items():
+            AnswerSheet.objects.update_answers_count(sheet_id, count)
+        if replaced:
+            AnswerSheet.objects.touch(replaced)
+
+        self.get_query_set().filter(pk__in=[row[0] for row in batch]).delete()
+        return len(batch)
+
+    def flush(self, batch_size=1000):
+        """ Flush all the buffered answers, a batch at a time. Returns the
+            number of buffered answers flushed, which is None if another
+            flush is running.
+        """
+        if not caching.acquire_flush_lock():
+            return None
+        flushed = 0
+        try:
+            while True:
+                count = self.flush_batch(batch_size)
+                if not count:
+                    return flushed
+                flushed += count
+        finally:
+            caching.release_flush_lock()
+
+
+class BufferedAnswer(models.Model):
+    """ An answer that was submitted, but not yet stored on the user's
+        answer sheet.
+    """
+    user = models.ForeignKey(User)
+    questionnaire = models.ForeignKey(Questionnaire)
+    question = models.ForeignKey(MultiChoiceQuestion)
+    chosen_option = models.ForeignKey(MultiChoiceOption)
+    date_created = models.DateTimeField(auto_now_add=True)
+
+    objects = BufferedAnswerManager()
+
+    def __unicode__(self):
+        return "%s: %s" % (self.questionnaire.title, self.user.username)
+
+
+class UserSurveyEligibilityManager(models.Manager):
+    """ Model manager for the materialized eligibility table.
+    """
+
+    def _build_rows(self, user_ids, declined, questionnaire_ids,
+                    prerequisites):
+        statuses = dict((user_id, {}) for user_id in user_ids)
+        qs = AnswerSheet.objects.filter(
+            user__in=user_ids,
+            questionnaire__in=questionnaire_ids).order_by()
+        for user_id, questionnaire_id, status in qs.values_list(
+                'user', 'questionnaire', 'status'):
+            statuses[user_id][questionnaire_id] = status
+        if use_answer_buffer():
+            BufferedAnswer.objects.merge_statuses(statuses)
+
+        rows = []
+        for user_id in user_ids:
+            resolver = PrerequisiteResolver(prerequisites,
+                                            statuses[user_id],
+                                            declined=user_id in declined)
+            for questionnaire_id in questionnaire_ids:
+                rows.append(self.model(
+                    user_id=user_id,
+                    questionnaire_id=questionnaire_id,
+                    status=resolver.get_sheet_status(questionnaire_id),
+                    eligible=resolver.is_eligible(questionnaire_id)))
+        return rows
+
+    def active_questionnaire_ids(self):
+        """ Return the ids of the active questionnaires, cached until the
+            questionnaires change.
+        """
+        version, questionnaire_ids = caching.get_active_questionnaires()
+        if questionnaire_ids is None:
+            questionnaire_ids = list(Questionnaire.objects.filter(
+                active=True).order_by().values_list('pk', flat=True))
+            caching.set_active_questionnaires(version, questionnaire_ids)
+        return questionnaire_ids
+
+    def rebuild(self, users, chunk_size=1000):
+        """ Rebuild the rows for the active questionnaires and the users
+            queryset, processing the users in chunks. Returns the number of
+            rows written.
+        """
+        questionnaire_ids = self.active_questionnaire_ids()
+        prerequisites = PrerequisiteResolver.load_prerequisites()
+
+        written = 0
+        for chunk, declined in iterate_users(users, chunk_size):
+            user_ids = [user.pk for user in chunk]
+            rows = self._build_rows(user_ids, declined, questionnaire_ids,
+                                    prerequisites)
+            self.get_query_set().filter(user__in=user_ids).delete()
+            self.bulk_create(rows)
+            written += len(rows)
+        return written
+
+    def remove_inactive(self):
+        """ Remove the rows of questionnaires that are no longer active, for
+            all the users.
+        """
+        self.get_query_set().exclude(
+            questionnaire__in=self.active_questionnaire_ids()).delete()
+
+    def refresh_for_user(self, user_id):
+        """ Bring the rows of a single user up to date after their answers or
+            profile changed. Only the rows that changed are written, and the
+            questionnaires come from the cache, so a status change usually
+            takes four queries.
+        """
+        rows = self._build_rows([user_id], get_declined_user_ids([user_id]),
+                                self.active_questionnaire_ids(),
+                                PrerequisiteResolver.load_prerequisites())
+
+        current = dict(
+            (questionnaire_id, (row_pk, row_status, row_eligible))
+            for row_pk, questionnaire_id, row_status, row_eligible in
+            self.get_query_set().filter(user=user_id).values_list(
+                'pk', 'questionnaire', 'status', 'eligible'))
+        missing = []
+        for row in rows:
+            if row.questionnaire_id not in current:
+                missing.append(row)
+                continue
+            pk, status, eligible = current.pop(row.questionnaire_id)
+            if (status, eligible) != (row.status, row.eligible):
+                self.get_query_set().filter(pk=pk).update(
+                    status=row.status,
+                    eligible=row.eligible)
+
+        # the rows left are those of questionnaires no longer active
+        if current:
+            stale_ids = [stale[0] for stale in current.values()]
+            self.get_query_set().filter(pk__in=stale_ids).delete()
+        if missing:
+            sid = transaction.savepoint()
+            try:
+                self.bulk_create(missing)
+            except IntegrityError:
+                # the rows were built by a concurrent request
+                transaction.savepoint_rollback(sid)
+            else:
+                transaction.savepoint_commit(sid)
+
+    def status_map(self, user):
+        """ Return a dictionary of questionnaire id to sheet status for the
+            active questionnaires, as used by ContentQuiz.get_status.
+        """
+        qs = self.get_query_set().filter(user=user).values_list(
+            'questionnaire', 'status')
+        return dict(self._rows_for_user(user, qs))
+
+    def _rows_for_user(self, user, qs):
+        # users without rows yet are materialized on first use
+        rows = list(qs)
+        if not rows:
+            self.refresh_for_user(user.pk)
+            rows = list(qs.all())
+        return rows
+
+    def questionnaire_for_user(self, user):
+        """ Return the first active questionnaire the user is eligible for.
+        """
+        qs = self.get_query_set().filter(user=user).select_related(
+            'questionnaire').order_by('questionnaire__date_created')
+        for row in self._rows_for_user(user, qs):
+            if row.eligible and row.questionnaire.active:
+                return row.questionnaire
+
+    def home_page_quizzes(self, user):
+        """ Return the active content linked quizzes the user is eligible for
+            that show on the home page.
+        """
+        qs = self.get_query_set().filter(user=user).values_list(
+            'questionnaire', 'eligible')
+        eligible_ids = [questionnaire_id for questionnaire_id, eligible in
+                        self._rows_for_user(user, qs) if eligible]
+        if not eligible_ids:
+            return []
+        return list(ContentQuiz.objects.filter(
+            pk__in=eligible_ids,
+            active=True,
+            show_on_home_page=True))
+
+
+class UserSurveyEligibility(models.Model):
+    """ Materialized status and eligibility of the active questionnaires for
+        every user, rebuilt by the survey_rebuild_eligibility command and
+        kept up to date as users answer or decline. Only used if the
+        SURVEY_USE_ELIGIBILITY_TABLE setting is enabled.
+    """
+    user = models.ForeignKey(User)
+    questionnaire = models.ForeignKey(Questionnaire)
+
+    # the status of the user's answer sheet, ignoring the declined flag
+    status = models.PositiveSmallIntegerField(
+        choices=constants.QUESTIONNAIRE_STATUSES,
+        default=constants.QUESTIONNAIRE_PENDING)
+    eligible = models.BooleanField(default=False)
+
+    objects = UserSurveyEligibilityManager()
+
+    def __unicode__(self):
+        return "%s for %s" % (self.questionnaire.title, self.user.username)
+
+    class Meta:
+        unique_together = ('user', 'questionnaire',)
+        verbose_name_plural = 'User survey eligibility'
+
+
+def user_changed(user_id, refresh=True):
+    """ Invalidate the cached data for a user whose answers or profile
+        changed. If the eligibility table is used, the user's rows are
+        refreshed, or dropped to be rebuilt on first use if the change was a
+        deletion, which could be part of deleting the user.
+    """
+    caching.invalidate_user(user_id)
+    if use_eligibility_table():
+        if refresh:
+            UserSurveyEligibility.objects.refresh_for_user(user_id)
+        else:
+            UserSurveyEligibility.objects.filter(user=user_id).delete()
+
+
+def _update_answer_sheet_counters(answer, delta):
+    result = AnswerSheet.objects.update_answers_count(answer.answer_sheet_id,
+                                                      delta)
+
+    # update the sheet instance the answer was created from as well
+    sheet = getattr(answer, '_answer_sheet_cache', None)
+    if sheet is not None and result is not None:
+        sheet.answers_count, sheet.status, sheet.completed_at = result
+
+
+def answer_saved(sender, instance, created, raw=False, **kwargs):
+    """ Keep the stored answer count and status of the answer sheet up to
+        date when an answer is added.
+    """
+    if created and not raw:
+        _update_answer_sheet_counters(instance, 1)
+
+
+post_save.connect(answer_saved, sender=MultiChoiceAnswer)
+
+
+def answer_deleted(sender, instance, **kwargs):
+    """ Keep the stored answer count and status of the answer sheet up to
+        date when an answer is removed.
+    """
+    _update_answer_sheet_counters(instance, -1)
+
+
+post_delete.connect(answer_deleted, sender=MultiChoiceAnswer)
+
+
+def question_changed(sender, instance, raw=False, **kwargs):
+    """ Adding or removing questions changes the status of the existing
+        answer sheets for the questionnaire.
+    """
+    if not raw:
+        AnswerSheet.objects.refresh_status(instance.questionnaire_id)
+        caching.bump_content_version()
+
+
+post_save.connect(question_changed, sender=MultiChoiceQuestion)
+post_delete.connect(question_changed, sender=MultiChoiceQuestion)
+
+
+def option_changed(sender, instance, raw=False, **kwargs):
+    """ Invalidate the cached questionnaire snapshots.
+    """
+    if not raw:
+        caching.bump_content_version()
+
+
+post_save.connect(option_changed, sender=MultiChoiceOption)
+post_delete.connect(option_changed, sender=MultiChoiceOption)
+
+
+def answer_sheet_saved(sender, instance, created, raw=False, **kwargs):
+    """ Invalidate the cached statuses for the owner of the sheet.
+    """
+    if not raw:
+        if created and instance.status == constants.QUESTIONNAIRE_PENDING:
+            # a new sheet without answers has the status of no sheet at all,
+            # so the eligibility rows stay the same.
+            caching.invalidate_user(instance.user_id)
+        else:
+            user_changed(instance.user_id)
+
+
+post_save.connect(answer_sheet_saved, sender=AnswerSheet)
+
+
+def answer_sheet_deleted(sender, instance, **kwargs):
+    """ Invalidate the cached statuses for the owner of the sheet.
+    """
+    user_changed(instance.user_id, refresh=False)
+    caching.bump_sheet_version(instance.user_id, instance.questionnaire_id)
+
+
+post_delete.connect(answer_sheet_deleted, sender=AnswerSheet)
+
+
+def profile_saved(sender, instance, raw=False, **kwargs):
+    """ Invalidate the cached statuses for the user when the profile, and so
+        possibly the decline_surveys flag, changes.
+    """
+    if not raw and sender is get_profile_model():
+        user_changed(instance.user_id)
+
+
+# the profile model may not be loaded yet, so check every saved model.
+post_save.connect(profile_saved)
+
+
+def questionnaire_changed(sender, instance, raw=False, **kwargs):
+    """ Changes to the required surveys invalidate the cached prerequisites.
+    """
+    if not raw:
+        caching.bump_content_version()
+
+
+post_save.connect(questionnaire_changed, sender=Questionnaire)
+post_delete.connect(questionnaire_changed, sender=Questionnaire)
+post_save.connect(questionnaire_changed, sender=ContentQuiz)
+post_delete.connect(questionnaire_changed, sender=ContentQuiz)
@@ -0,0 +1,85 @@
+""" Track the questions a respondent answered in their session, so that
+    displaying the next question does not have to query the answers.
+
+    The answered question ids are stored together with the version of the
+    user's answers to the questionnaire, which is shared in the cache and
+    changes whenever answers are added or removed. Answers given on another
+    device change the version, and the ids are then loaded from the database
+    again.
+"""
+from django.conf import settings
+
+from survey import caching
+from survey.models import MultiChoiceAnswer
+
+SESSION_KEY = 'survey_progress'
+
+
+def track_progress():
+    """ Whether the answered questions are tracked in the session.
+    """
+    return getattr(settings, 'SURVEY_TRACK_PROGRESS', False)
+
+
+class ProgressTracker(object):
+    """ The questions a user answered in a questionnaire, kept in the
+        session.
+    """
+
+    def __init__(self, session, user_id, questionnaire_id):
+        self.session = session
+        self.user_id = user_id
+        self.questionnaire_id = int(questionnaire_id)
+        self.version_before_answers = None
+
+    def _get_entry(self):
+        return self.session.get(SESSION_KEY, {}).get(self.questionnaire_id)
+
+    def _set_entry(self, entry):
+        # assign a new dict, so that the session is saved
+        progress = dict(self.session.get(SESSION_KEY, {}))
+        if entry is None:
+            progress.pop(self.questionnaire_id, None)
+        else:
+            progress[self.questionnaire_id] = entry
+        self.session[SESSION_KEY] = progress
+
+    def answered_question_ids(self):
+        """ Return the ids of the answered questions. They are only loaded
+            from the database if the session has none for the current
+            version of the user's answers.
+        """
+        version = caching.get_sheet_version(self.user_id,
+                                            self.questionnaire_id)
+        entry = self._get_entry()
+        if entry is not None and entry[0] == version:
+            caching.incr_stat('progress_hits')
+            return entry[1]
+
+        caching.incr_stat('progress_misses')
+        question_ids = frozenset(
+            MultiChoiceAnswer.objects.answered_question_ids(
+                self.user_id, self.questionnaire_id))
+        self._set_entry((version, question_ids))
+        return question_ids
+
+    def begin_answers(self):
+        """ Call before storing answers, to note the version they change.
+        """
+        self.version_before_answers = caching.get_sheet_version(
+            self.user_id, self.questionnaire_id)
+
+    def answers_stored(self, question_ids):
+        """ Add the questions just answered to the session. Storing answers
+            changes the version once at most, any other change means the
+            answers were changed elsewhere too, and the ids are dropped.
+        """
+        version = caching.get_sheet_version(self.user_id,
+                                            self.questionnaire_id)
+        entry = self._get_entry()
+        before = self.version_before_answers
+        if (entry is not None and before is not None and
+                entry[0] == before and version in (before, before + 1)):
+            self._set_entry((version, entry[1].union(question_ids)))
+        else:
+            self._set_entry(None)
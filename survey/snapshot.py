@@ -0,0 +1,168 @@
+""" Immutable snapshots of the content of a questionnaire: its questions,
+    their options and the correct options.
+
+    Questionnaire content is edited rarely, so snapshots are kept in a per
+    process LRU and in the shared cache, keyed by the content version that is
+    bumped whenever a questionnaire, question or option is saved.
+"""
+import threading
+from collections import namedtuple, OrderedDict
+
+from django.core.cache import cache
+
+from survey import caching
+from survey.models import Questionnaire, MultiChoiceQuestion, MultiChoiceOption
+
+SNAPSHOT_KEY = 'survey:snapshot:%s:%s'
+LOCAL_CACHE_SIZE = 32
+
+OptionSnapshot = namedtuple('OptionSnapshot', (
+    'pk', 'option_order', 'option_text', 'is_correct_option'))
+
+QuestionSnapshot = namedtuple('QuestionSnapshot', (
+    'pk', 'question_order', 'question_text', 'options'))
+
+
+class QuestionnaireSnapshot(object):
+    """ The loaded content of a questionnaire. Questions are ordered by
+        question_order, and their options by option_order.
+    """
+
+    def __init__(self, version, pk, title, introduction_text,
+                 thank_you_text, questions_per_page, questions):
+        self.version = version
+        self.pk = pk
+        self.title = title
+        self.introduction_text = introduction_text
+        self.thank_you_text = thank_you_text
+        self.questions_per_page = questions_per_page
+        self.questions = tuple(questions)
+        self.number_of_questions = len(self.questions)
+        self.correct_option_ids = frozenset(
+            option.pk for question in self.questions
+            for option in question.options if option.is_correct_option)
+        self._questions_by_id = dict(
+            (question.pk, question) for question in self.questions)
+
+    def __unicode__(self):
+        return self.title
+
+    def get_question(self, question_id):
+        """ Return the question with the given id, or None if it is not part
+            of the questionnaire.
+        """
+        try:
+            return self._questions_by_id.get(int(question_id))
+        except (TypeError, ValueError):
+            return None
+
+    def get_option(self, question_id, option_id):
+        """ Return the option with the given id for the question, or None if
+            it is not one of the question's options.
+        """
+        question = self.get_question(question_id)
+        if question is not None:
+            for option in question.options:
+                if str(option.pk) == str(option_id):
+                    return option
+
+    def next_questions(self, answered_question_ids, count=1):
+        """ Return up to count of the first questions not answered yet.
+        """
+        answered_question_ids = set(answered_question_ids)
+        result = []
+        for question in self.questions:
+            if question.pk not in answered_question_ids:
+                result.append(question)
+                if len(result) == count:
+                    break
+        return result
+
+    def next_question(self, answered_question_ids):
+        questions = self.next_questions(answered_question_ids)
+        if questions:
+            return questions[0]
+
+    def score(self, chosen_option_ids):
+        """ Count the correct options among the chosen ones.
+        """
+        return len([pk for pk in chosen_option_ids
+                    if pk in self.correct_option_ids])
+
+
+def build_snapshot(questionnaire_id, version):
+    """ Load a questionnaire snapshot with three queries.
+    """
+    questionnaire = Questionnaire.objects.filter(pk=questionnaire_id).values(
+        'pk', 'title', 'introduction_text', 'thank_you_text',
+        'questions_per_page').get()
+
+    options = {}
+    qs = MultiChoiceOption.objects.filter(
+        question__questionnaire=questionnaire_id).order_by(
+            'option_order', 'pk')
+    for pk, question_id, option_order, option_text, is_correct_option in \
+            qs.values_list('pk', 'question', 'option_order', 'option_text',
+                           'is_correct_option'):
+        options.setdefault(question_id, []).append(OptionSnapshot(
+            pk, option_order, option_text, is_correct_option))
+
+    qs = MultiChoiceQuestion.objects.filter(
+        questionnaire=questionnaire_id).order_by('question_order', 'pk')
+    questions = [
+        QuestionSnapshot(pk, question_order, question_text,
+                         tuple(options.get(pk, ())))
+        for pk, question_order, question_text in qs.values_list(
+            'pk', 'question_order', 'question_text')]
+
+    return QuestionnaireSnapshot(version=version, questions=questions,
+                                 **questionnaire)
+
+
+class LocalSnapshotCache(object):
+    """ A small thread safe LRU of snapshots for this process.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.lock = threading.Lock()
+        self.snapshots = OrderedDict()
+
+    def get(self, questionnaire_id, version):
+        with self.lock:
+            snapshot = self.snapshots.pop(questionnaire_id, None)
+            if snapshot is None or snapshot.version != version:
+                return None
+            self.snapshots[questionnaire_id] = snapshot
+            return snapshot
+
+    def set(self, snapshot):
+        with self.lock:
+            self.snapshots.pop(snapshot.pk, None)
+            self.snapshots[snapshot.pk] = snapshot
+            while len(self.snapshots) > self.size:
+                self.snapshots.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.snapshots.clear()
+
+
+local_snapshots = LocalSnapshotCache(LOCAL_CACHE_SIZE)
+
+
+def get_snapshot(questionnaire_id):
+    """ Return the snapshot for the current content of a questionnaire.
+        Raises Questionnaire.DoesNotExist if there is no such questionnaire.
+    """
+    questionnaire_id = int(questionnaire_id)
+    version = caching.get_content_version()
+    snapshot = local_snapshots.get(questionnaire_id, version)
+    if snapshot is None:
+        key = SNAPSHOT_KEY % (version, questionnaire_id)
+        snapshot = cache.get(key)
+        if snapshot is None:
+            snapshot = build_snapshot(questionnaire_id, version)
+            cache.set(key, snapshot, caching.ENTRY_TIMEOUT)
+        local_snapshots.set(snapshot)
+    return snapshot
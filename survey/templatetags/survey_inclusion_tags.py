@@ -2,7 +2,8 @@ from copy import copy
 
 from django import template
 
-from survey.models import Questionnaire, ContentQuiz
+from survey.models import (Questionnaire, ContentQuiz,
+                           UserSurveyEligibility, use_eligibility_table)
 from survey.constants import QUESTIONNAIRE_INCOMPLETE, QUESTIONNAIRE_PENDING
 
 
@@ -49,11 +50,17 @@ def post_content_quizzes(context, post):
     context = copy(context)
     user = context['user']
     result = []
+    statuses = {}
+    if use_eligibility_table() and user.is_authenticated():
+        statuses = UserSurveyEligibility.objects.status_map(user)
     quizzes = post.post_quiz_set.all()
     for item in quizzes:
         quiz = item.quiz
-        if quiz.get_status(user) in (QUESTIONNAIRE_INCOMPLETE,
-                                     QUESTIONNAIRE_PENDING):
+        # inactive quizzes have no rows in the eligibility table
+        status = statuses.get(quiz.pk)
+        if status is None:
+            status = quiz.get_status(user)
+        if status in (QUESTIONNAIRE_INCOMPLETE, QUESTIONNAIRE_PENDING):
             result.append(quiz)
     if result:
         context.update({
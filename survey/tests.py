@@ -1,17 +1,44 @@
 # -*- coding: utf-8 -*-
+import csv
+import datetime
+import gzip
+import hashlib
+import os
+import shutil
+import tempfile
 
 from mock import patch
 
 from StringIO import StringIO
 
 from django.utils import unittest
+from django.contrib import admin
+from django.db import connection, connections
 from django.db.utils import IntegrityError, DatabaseError
+from django.db.models import F
 from django.contrib.auth.models import User
-
-from survey import constants
-from survey.management.commands import survey_answersheet_csv_export
+from django.core.exceptions import ValidationError
+from django.core.management.base import CommandError
+from django.core.signals import request_finished
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
+
+from survey import caching, constants
+from survey.management.commands import (survey_answersheet_csv_export,
+                                        survey_rebuild_eligibility,
+                                        survey_flush_answers)
+from survey import export
+from survey.admin import AnswerSheetAdmin, QuestionnaireAdmin
+from survey.snapshot import get_snapshot, local_snapshots
+from survey.views import CheckForQuestionnaireView, SurveyFormView
+from survey.templatetags.survey_inclusion_tags import post_content_quizzes
+from survey.forms import SurveyQuestionForm, SurveyQuestionsForm, as_div
 from survey.models import (Questionnaire, ContentQuiz, MultiChoiceQuestion,
-                           MultiChoiceOption, AnswerSheet, MultiChoiceAnswer)
+                           MultiChoiceOption, AnswerSheet, MultiChoiceAnswer,
+                           ContentQuizToPost,
+                           UserSurveyEligibility, BufferedAnswer,
+                           PrerequisiteResolver, calculate_status,
+                           find_cycle)
 from post.models import Post
 
 
@@ -70,6 +97,18 @@ class BaseSurveyTestCase(unittest.TestCase):
         return question1.multichoiceoption_set.filter(
             option_text='Option 2').get()
 
+    def count_queries(self, func, *args, **kwargs):
+        """ Call func, returning its result and the number of queries run.
+        """
+        old_debug_cursor = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+        starting_queries = len(connection.queries)
+        try:
+            result = func(*args, **kwargs)
+        finally:
+            connection.use_debug_cursor = old_debug_cursor
+        return result, len(connection.queries) - starting_queries
+
 
 class SurveyTestCase(BaseSurveyTestCase):
 
@@ -153,7 +192,8 @@ class SurveyTestCase(BaseSurveyTestCase):
             created_by=boss_man,
             active=True)
 
-        #ensure questionnaire 2 cannot be answered if questionnaire 3 is unanswered
+        #ensure questionnaire 2 cannot be answered if questionnaire 3 is
+        #unanswered
         questionnaire2.target_survey_users = questionnaire3
         questionnaire2.save()
         self.assertEqual(
@@ -164,6 +204,146 @@ class SurveyTestCase(BaseSurveyTestCase):
         boss_man.delete()
         guinea_pig.delete()
 
+    def test_available_questionnaire_queries(self):
+        boss_man = self.create_boss_man()
+        guinea_pig = self.create_guinea_pig('thepig')
+
+        # the pre-test must be completed before the post-test is available
+        pre_test = self.create_questionnaire(boss_man)
+        pre_test.active = True
+        pre_test.save()
+        post_test = self.create_questionnaire(boss_man)
+        post_test.active = True
+        post_test.target_survey_users = pre_test
+        post_test.save()
+        for idx in range(3):
+            questionnaire = self.create_questionnaire(boss_man)
+            questionnaire.target_survey_users = post_test
+            questionnaire.active = True
+            questionnaire.save()
+
+        # the required surveys and statuses are loaded once and cached, so
+        # only the active questionnaires are fetched on the next call.
+        result, queries = self.count_queries(
+            Questionnaire.objects.questionnaire_for_user, guinea_pig)
+        self.assertEqual(result, pre_test)
+        self.assertEqual(queries, 3)
+        result, queries = self.count_queries(
+            Questionnaire.objects.questionnaire_for_user, guinea_pig)
+        self.assertEqual(result, pre_test)
+        self.assertEqual(queries, 1)
+
+        # complete the pre-test, the post-test becomes available
+        sheet = AnswerSheet.objects.create(
+            questionnaire=pre_test,
+            user=guinea_pig)
+        question1 = self.get_question1(pre_test)
+        sheet.multichoiceanswer_set.create(
+            question=question1,
+            chosen_option=self.get_option2(question1))
+        result, queries = self.count_queries(
+            Questionnaire.objects.questionnaire_for_user, guinea_pig)
+        self.assertEqual(result, post_test)
+        self.assertEqual(queries, 2)
+
+        Questionnaire.objects.all().delete()
+        boss_man.delete()
+        guinea_pig.delete()
+
+    def test_required_survey_cycle(self):
+        boss_man = self.create_boss_man()
+        guinea_pig = self.create_guinea_pig('thepig')
+        questionnaire1 = self.create_questionnaire(boss_man)
+        questionnaire2 = self.create_questionnaire(boss_man)
+        questionnaire2.target_survey_users = questionnaire1
+        questionnaire2.save()
+
+        # questionnaire 1 may not require questionnaire 2
+        questionnaire1.target_survey_users = questionnaire2
+        self.assertRaises(ValidationError, questionnaire1.clean)
+        self.assertEqual(find_cycle({questionnaire1.pk: questionnaire2.pk,
+                                     questionnaire2.pk: questionnaire1.pk},
+                                    questionnaire2.pk),
+                         [questionnaire2.pk, questionnaire1.pk,
+                          questionnaire2.pk])
+
+        # a cycle saved anyway locks both questionnaires without recursing
+        questionnaire1.save()
+        resolver = PrerequisiteResolver.for_user(guinea_pig)
+        self.assertEqual(
+            resolver.unlocked_map([questionnaire1.pk, questionnaire2.pk]),
+            {questionnaire1.pk: False, questionnaire2.pk: False})
+
+        Questionnaire.objects.all().delete()
+        boss_man.delete()
+        guinea_pig.delete()
+
+    @override_settings(SURVEY_USE_ELIGIBILITY_TABLE=True)
+    def test_eligibility_table(self):
+        boss_man = self.create_boss_man()
+        guinea_pig = self.create_guinea_pig('thepig')
+        pre_test = self.create_questionnaire(boss_man)
+        pre_test.active = True
+        pre_test.save()
+        post_test = self.create_questionnaire(boss_man)
+        post_test.active = True
+        post_test.target_survey_users = pre_test
+        post_test.save()
+
+        # the rows are built on first use
+        self.assertEqual(
+            Questionnaire.objects.questionnaire_for_user(guinea_pig),
+            pre_test)
+        self.assertEqual(
+            UserSurveyEligibility.objects.filter(user=guinea_pig).count(), 2)
+        result, queries = self.count_queries(
+            Questionnaire.objects.questionnaire_for_user, guinea_pig)
+        self.assertEqual(result, pre_test)
+        self.assertEqual(queries, 1)
+
+        # completing the pre-test updates the rows
+        sheet = AnswerSheet.objects.create(
+            questionnaire=pre_test,
+            user=guinea_pig)
+        question1 = self.get_question1(pre_test)
+        sheet.multichoiceanswer_set.create(
+            question=question1,
+            chosen_option=self.get_option2(question1))
+        self.assertEqual(
+            Questionnaire.objects.questionnaire_for_user(guinea_pig),
+            post_test)
+        row = UserSurveyEligibility.objects.get(user=guinea_pig,
+                                                questionnaire=pre_test)
+        self.assertEqual(row.status, constants.QUESTIONNAIRE_COMPLETED)
+        self.assertFalse(row.eligible)
+
+        # a refresh only writes the rows that changed
+        result, queries = self.count_queries(
+            UserSurveyEligibility.objects.refresh_for_user, guinea_pig.pk)
+        self.assertEqual(queries, 3)
+        sheet.multichoiceanswer_set.all().delete()
+        UserSurveyEligibility.objects.refresh_for_user(guinea_pig.pk)
+        result, queries = self.count_queries(
+            sheet.multichoiceanswer_set.create,
+            question=question1,
+            chosen_option=self.get_option2(question1))
+        self.assertEqual(queries, 9)
+        self.assertEqual(
+            UserSurveyEligibility.objects.filter(user=guinea_pig,
+                                                 eligible=True).count(), 1)
+
+        # the command rebuilds the rows for all the active users
+        UserSurveyEligibility.objects.all().delete()
+        command = survey_rebuild_eligibility.Command()
+        command.handle(chunk_size=1)
+        self.assertEqual(
+            UserSurveyEligibility.objects.filter(user=guinea_pig,
+                                                 eligible=True).count(), 1)
+
+        Questionnaire.objects.all().delete()
+        boss_man.delete()
+        guinea_pig.delete()
+
     @patch.object(User, 'get_profile')
     def test_available_questionnaire_for_declined_user(self, get_profile):
         get_profile.return_value = DummyProfile(True)
@@ -220,9 +400,10 @@ class SurveyTestCase(BaseSurveyTestCase):
         sheet.multichoiceanswer_set.create(
             question=question1,
             chosen_option=option2)
-        self.assertEqual(
-            questionnaire1.get_next_question_for_user(guinea_pig),
-            question2)
+        result, queries = self.count_queries(
+            questionnaire1.get_next_question_for_user, guinea_pig)
+        self.assertEqual(result, question2)
+        self.assertEqual(queries, 1)
 
         # Create an answer for question 2. We should expect to get no next
         # question
@@ -303,6 +484,187 @@ class SurveyTestCase(BaseSurveyTestCase):
         guinea_pig.delete()
         guinea_pig4.delete()
 
+    def test_stored_status(self):
+        boss_man = self.create_boss_man()
+        questionnaire1 = self.create_questionnaire(boss_man)
+        guinea_pig = self.create_guinea_pig('thepig')
+
+        sheet = AnswerSheet.objects.create(
+            questionnaire=questionnaire1,
+            user=guinea_pig)
+        question1 = self.get_question1(questionnaire1)
+        answer = sheet.multichoiceanswer_set.create(
+            question=question1,
+            chosen_option=self.get_option2(question1))
+
+        # the stored fields are updated in the database
+        sheet = AnswerSheet.objects.get(pk=sheet.pk)
+        self.assertEqual(sheet.answers_count, 1)
+        self.assertEqual(sheet.status, constants.QUESTIONNAIRE_COMPLETED)
+        self.assertIsNotNone(sheet.completed_at)
+        self.assertEqual(
+            AnswerSheet.objects.filter(
+                status=constants.QUESTIONNAIRE_COMPLETED).count(), 1)
+
+        # adding a question makes the sheet incomplete
+        question2 = questionnaire1.multichoicequestion_set.create(
+            question_order=1,
+            question_text='Question 2')
+        sheet = AnswerSheet.objects.get(pk=sheet.pk)
+        self.assertEqual(sheet.status, constants.QUESTIONNAIRE_INCOMPLETE)
+        self.assertIsNone(sheet.completed_at)
+
+        # and removing it again completes the sheet
+        question2.delete()
+        sheet = AnswerSheet.objects.get(pk=sheet.pk)
+        self.assertEqual(sheet.status, constants.QUESTIONNAIRE_COMPLETED)
+
+        # removing the answer makes the sheet pending again
+        answer.delete()
+        sheet = AnswerSheet.objects.get(pk=sheet.pk)
+        self.assertEqual(sheet.answers_count, 0)
+        self.assertEqual(sheet.status, constants.QUESTIONNAIRE_PENDING)
+        self.assertIsNone(sheet.completed_at)
+
+        # the status is not written for a count changed by a concurrent
+        # answer, which writes the status itself
+        def concurrent_change(questions, answers):
+            AnswerSheet.objects.filter(pk=sheet.pk).update(
+                answers_count=F('answers_count') - 1)
+            return calculate_status(questions, answers)
+
+        with patch('survey.models.calculate_status',
+                   side_effect=concurrent_change):
+            with patch('survey.models.user_changed') as user_changed:
+                AnswerSheet.objects.update_answers_count(sheet.pk, 1)
+        self.assertFalse(user_changed.called)
+        sheet = AnswerSheet.objects.get(pk=sheet.pk)
+        self.assertEqual(sheet.answers_count, 0)
+        self.assertEqual(sheet.status, constants.QUESTIONNAIRE_PENDING)
+
+        questionnaire1.delete()
+        boss_man.delete()
+        guinea_pig.delete()
+
+    def test_status_cache(self):
+        boss_man = self.create_boss_man()
+        questionnaire1 = self.create_questionnaire(boss_man)
+        guinea_pig = self.create_guinea_pig('thepig')
+        caching.reset_stats('status_map_hits', 'status_map_misses')
+
+        # the first lookup calculates the statuses, the next uses the cache
+        status, queries = self.count_queries(
+            questionnaire1.get_status, guinea_pig)
+        self.assertEqual(status, constants.QUESTIONNAIRE_PENDING)
+        self.assertEqual(queries, 1)
+        status, queries = self.count_queries(
+            questionnaire1.get_status, guinea_pig)
+        self.assertEqual(status, constants.QUESTIONNAIRE_PENDING)
+        self.assertEqual(queries, 0)
+        self.assertEqual(
+            caching.get_stats('status_map_hits', 'status_map_misses'),
+            {'status_map_hits': 1, 'status_map_misses': 1})
+
+        # answering the question invalidates the cached statuses
+        sheet = AnswerSheet.objects.create(
+            questionnaire=questionnaire1,
+            user=guinea_pig)
+        question1 = self.get_question1(questionnaire1)
+        sheet.multichoiceanswer_set.create(
+            question=question1,
+            chosen_option=self.get_option2(question1))
+        self.assertEqual(questionnaire1.get_status(guinea_pig),
+                         constants.QUESTIONNAIRE_COMPLETED)
+
+        # and so does adding a question
+        questionnaire1.multichoicequestion_set.create(
+            question_order=1,
+            question_text='Question 2')
+        self.assertEqual(questionnaire1.get_status(guinea_pig),
+                         constants.QUESTIONNAIRE_INCOMPLETE)
+
+        # statuses computed before the user's answers changed are not stored
+        # as current
+        version, statuses = caching.get_status_map(guinea_pig.pk)
+        caching.invalidate_user(guinea_pig.pk)
+        caching.set_status_map(guinea_pig.pk, version,
+                               {questionnaire1.pk: 'stale'})
+        self.assertIsNone(caching.get_status_map(guinea_pig.pk)[1])
+        self.assertEqual(questionnaire1.get_status(guinea_pig),
+                         constants.QUESTIONNAIRE_INCOMPLETE)
+
+        questionnaire1.delete()
+        boss_man.delete()
+        guinea_pig.delete()
+
+    def test_status_matrix(self):
+        boss_man = self.create_boss_man()
+        questionnaire1 = self.create_questionnaire(boss_man)
+        guinea_pig = self.create_guinea_pig('thepig')
+        guinea_pig2 = self.create_guinea_pig('thepig2')
+        decliner = self.create_guinea_pig('decliner')
+        content_quiz = ContentQuiz.objects.create(
+            banner_description='Banner',
+            introduction_text='Content Intro text',
+            thank_you_text='Content Thank you',
+            created_by=boss_man)
+
+        # guinea_pig completes both, the decliner completes the content quiz
+        question1 = self.get_question1(questionnaire1)
+        option2 = self.get_option2(question1)
+        quiz_question = content_quiz.multichoicequestion_set.create(
+            question_order=0,
+            question_text='Content Question 1')
+        quiz_option = quiz_question.multichoiceoption_set.create(
+            option_order=0,
+            option_text='Content Option 1')
+        for user, questionnaire, question, option in (
+                (guinea_pig, questionnaire1, question1, option2),
+                (guinea_pig, content_quiz, quiz_question, quiz_option),
+                (decliner, content_quiz, quiz_question, quiz_option)):
+            sheet = AnswerSheet.objects.create(
+                questionnaire=questionnaire,
+                user=user)
+            sheet.multichoiceanswer_set.create(
+                question=question,
+                chosen_option=option)
+
+        users = User.objects.filter(pk__in=[guinea_pig.pk, guinea_pig2.pk,
+                                            decliner.pk])
+        questionnaires = Questionnaire.objects.filter(pk=questionnaire1.pk)
+        quizzes = ContentQuiz.objects.filter(pk=content_quiz.pk)
+        with patch.object(User, 'profile', property(
+                lambda u: DummyProfile(u.username == 'decliner'))):
+            matrix = list(Questionnaire.objects.status_matrix(
+                users, questionnaires, chunk_size=2))
+            counts = Questionnaire.objects.status_counts(
+                users, questionnaires, chunk_size=2)
+            quiz_counts = Questionnaire.objects.status_counts(users, quizzes)
+
+        # the results must match get_status for every user
+        self.assertEqual(
+            matrix,
+            [(guinea_pig.pk, questionnaire1.pk,
+              constants.QUESTIONNAIRE_COMPLETED),
+             (guinea_pig2.pk, questionnaire1.pk,
+              constants.QUESTIONNAIRE_PENDING),
+             (decliner.pk, questionnaire1.pk,
+              constants.QUESTIONNAIRE_REJECTED)])
+        self.assertEqual(counts, {questionnaire1.pk: {
+            constants.QUESTIONNAIRE_COMPLETED: 1,
+            constants.QUESTIONNAIRE_INCOMPLETE: 0,
+            constants.QUESTIONNAIRE_PENDING: 1,
+            constants.QUESTIONNAIRE_REJECTED: 1}})
+        self.assertEqual(quiz_counts, {content_quiz.pk: {
+            constants.QUESTIONNAIRE_COMPLETED: 2,
+            constants.QUESTIONNAIRE_INCOMPLETE: 0,
+            constants.QUESTIONNAIRE_PENDING: 1,
+            constants.QUESTIONNAIRE_REJECTED: 0}})
+
+        Questionnaire.objects.all().delete()
+        boss_man.delete()
+        users.delete()
+
     def test_score(self):
         boss_man = self.create_boss_man()
         questionnaire1 = self.create_questionnaire(boss_man)
@@ -365,6 +727,87 @@ class SurveyTestCase(BaseSurveyTestCase):
         guinea_pig.delete()
         guinea_pig2.delete()
 
+    def test_snapshot(self):
+        boss_man = self.create_boss_man()
+        questionnaire1 = self.create_questionnaire(boss_man)
+        question2 = questionnaire1.multichoicequestion_set.create(
+            question_order=1,
+            question_text='Question 2')
+        q2option1 = question2.multichoiceoption_set.create(
+            option_order=0,
+            option_text='Option 1',
+            is_correct_option=True)
+        question1 = self.get_question1(questionnaire1)
+        option2 = self.get_option2(question1)
+
+        # the snapshot is built with a fixed number of queries
+        local_snapshots.clear()
+        caching.bump_content_version()
+        snapshot, queries = self.count_queries(get_snapshot,
+                                               questionnaire1.pk)
+        self.assertEqual(queries, 3)
+        self.assertEqual(snapshot.number_of_questions, 2)
+        self.assertEqual([q.pk for q in snapshot.questions],
+                         [question1.pk, question2.pk])
+        self.assertEqual(
+            [o.option_text for o in snapshot.questions[0].options],
+            ['Option 1', 'Option 2'])
+        self.assertEqual(snapshot.correct_option_ids,
+                         frozenset([option2.pk, q2option1.pk]))
+        self.assertEqual(snapshot.next_question([question1.pk]).pk,
+                         question2.pk)
+        self.assertEqual(snapshot.score([option2.pk, q2option1.pk]), 2)
+
+        # after that it is read from the process and shared caches
+        self.assertEqual(self.count_queries(get_snapshot,
+                                            questionnaire1.pk)[1], 0)
+        local_snapshots.clear()
+        self.assertEqual(self.count_queries(get_snapshot,
+                                            questionnaire1.pk)[1], 0)
+
+        # editing an option replaces the snapshot
+        q2option1.option_text = 'Changed'
+        q2option1.save()
+        snapshot = get_snapshot(questionnaire1.pk)
+        self.assertEqual(snapshot.questions[1].options[0].option_text,
+                         'Changed')
+
+        questionnaire1.delete()
+        boss_man.delete()
+
+    def test_question_fragment_cache(self):
+        boss_man = self.create_boss_man()
+        questionnaire1 = self.create_questionnaire(boss_man)
+        question2 = questionnaire1.multichoicequestion_set.create(
+            question_order=1,
+            question_text='Question 2')
+        question2.multichoiceoption_set.create(
+            option_order=0,
+            option_text='Option 1',
+            is_correct_option=True)
+        snapshot = get_snapshot(questionnaire1.pk)
+        caching.reset_stats('fragment_hits', 'fragment_misses')
+
+        # the cached rendering matches the uncached one
+        for i in range(2):
+            form = SurveyQuestionForm()
+            form.update_the_form(questionnaire1.pk, snapshot.questions[0],
+                                 snapshot.version)
+            form.fields['page_token'].initial = 'token%s' % i
+            self.assertEqual(form.as_div(), as_div(form))
+            self.assertTrue('token%s' % i in form.as_div())
+
+            form = SurveyQuestionsForm()
+            form.add_the_questions(questionnaire1.pk, snapshot.questions,
+                                   snapshot.version)
+            self.assertEqual(form.as_div(), as_div(form))
+        self.assertEqual(
+            caching.get_stats('fragment_hits', 'fragment_misses'),
+            {'fragment_hits': 5, 'fragment_misses': 3})
+
+        questionnaire1.delete()
+        boss_man.delete()
+
     def test_unique(self):
         boss_man = self.create_boss_man()
         questionnaire1 = self.create_questionnaire(boss_man)
@@ -379,6 +822,26 @@ class SurveyTestCase(BaseSurveyTestCase):
                           questionnaire=questionnaire1,
                           user=guinea_pig)
 
+        # a question can only be answered once on a sheet
+        question1 = self.get_question1(questionnaire1)
+        option1 = question1.multichoiceoption_set.get(option_text='Option 1')
+        option2 = self.get_option2(question1)
+        sheet1.multichoiceanswer_set.create(question=question1,
+                                            chosen_option=option1)
+        self.assertRaises(IntegrityError,
+                          sheet1.multichoiceanswer_set.create,
+                          question=question1,
+                          chosen_option=option2)
+
+        # answering it again replaces the chosen option
+        self.assertFalse(MultiChoiceAnswer.objects.answer(
+            sheet1, question1.pk, option2.pk))
+        sheet1 = AnswerSheet.objects.get(pk=sheet1.pk)
+        self.assertEqual(sheet1.number_of_questions_answered(), 1)
+        self.assertEqual(sheet1.get_status(),
+                         constants.QUESTIONNAIRE_COMPLETED)
+        self.assertEqual(sheet1.calculate_score(), 1)
+
         questionnaire1.delete()
         boss_man.delete()
         guinea_pig.delete()
@@ -466,6 +929,424 @@ class SurveyTestCase(BaseSurveyTestCase):
         guinea_pig.delete()
         guinea_pig3.delete()
 
+    def test_score_map(self):
+        boss_man = self.create_boss_man()
+        questionnaire1 = self.create_questionnaire(boss_man)
+        question1 = self.get_question1(questionnaire1)
+        option1 = question1.multichoiceoption_set.get(option_text='Option 1')
+        option2 = self.get_option2(question1)
+        question2 = questionnaire1.multichoicequestion_set.create(
+            question_order=1,
+            question_text='Question 2')
+        q2option1 = question2.multichoiceoption_set.create(
+            option_order=0,
+            option_text='Option 1',
+            is_correct_option=True)
+        guinea_pig = self.create_guinea_pig('thepig')
+        guinea_pig2 = self.create_guinea_pig('thepig2')
+        sheet1 = AnswerSheet.objects.create(questionnaire=questionnaire1,
+                                            user=guinea_pig)
+        sheet1.multichoiceanswer_set.create(question=question1,
+                                            chosen_option=option2)
+        sheet1.multichoiceanswer_set.create(question=question2,
+                                            chosen_option=q2option1)
+        sheet2 = AnswerSheet.objects.create(questionnaire=questionnaire1,
+                                            user=guinea_pig2)
+        sheet2.multichoiceanswer_set.create(question=question1,
+                                            chosen_option=option1)
+        sheet3 = AnswerSheet.objects.create(questionnaire=questionnaire1,
+                                            user=boss_man)
+
+        scores, queries = self.count_queries(
+            AnswerSheet.objects.score_map,
+            [sheet1.pk, sheet2.pk, sheet3.pk])
+        self.assertEqual(queries, 1)
+        self.assertEqual(scores, {sheet1.pk: (2, 2),
+                                  sheet2.pk: (0, 1),
+                                  sheet3.pk: (0, 0)})
+        for sheet in (sheet1, sheet2, sheet3):
+            self.assertEqual(scores[sheet.pk][0], sheet.calculate_score())
+
+        self.assertEqual(
+            self.count_queries(AnswerSheet.objects.get_max_answers),
+            (2, 1))
+
+        questionnaire1.delete()
+        boss_man.delete()
+        guinea_pig.delete()
+        guinea_pig2.delete()
+
+
+class SurveyViewsTestCase(BaseSurveyTestCase):
+
+    def test_check_for_survey_fast_path(self):
+        boss_man = self.create_boss_man()
+        questionnaire1 = self.create_questionnaire(boss_man)
+        guinea_pig = self.create_guinea_pig('thepig')
+        caching.reset_stats('check_fast_path', 'check_full_path')
+
+        request = RequestFactory().get('/survey/check-for-survey/')
+        request.user = guinea_pig
+        view = CheckForQuestionnaireView()
+        view.request = request
+
+        # nothing is available, which is remembered for the next check
+        self.assertEqual(view.get_redirect_url(), '/')
+        url, queries = self.count_queries(view.get_redirect_url)
+        self.assertEqual(url, '/')
+        self.assertEqual(queries, 0)
+        self.assertEqual(
+            caching.get_stats('check_fast_path', 'check_full_path'),
+            {'check_fast_path': 1, 'check_full_path': 1})
+
+        # activating a questionnaire invalidates the marker
+        questionnaire1.active = True
+        questionnaire1.save()
+        self.assertFalse(caching.get_nothing_available(guinea_pig.pk)[1])
+        self.assertEqual(
+            Questionnaire.objects.questionnaire_for_user(guinea_pig),
+            questionnaire1)
+
+        # a marker computed before the user's data changed is not stored as
+        # current
+        version, nothing_available = caching.get_nothing_available(
+            guinea_pig.pk)
+        caching.invalidate_user(guinea_pig.pk)
+        caching.set_nothing_available(guinea_pig.pk, version)
+        self.assertFalse(caching.get_nothing_available(guinea_pig.pk)[1])
+
+        questionnaire1.delete()
+        boss_man.delete()
+        guinea_pig.delete()
+
+    @patch.object(SurveyFormView, 'get_success_url',
+                  lambda self, survey_id: '/next/')
+    def test_answer_post_queries(self):
+        self.check_answer_post_queries(SurveyFormView.POST_QUERY_BUDGET)
+
+    @patch.object(SurveyFormView, 'get_success_url',
+                  lambda self, survey_id: '/next/')
+    @override_settings(SURVEY_USE_ELIGIBILITY_TABLE=True)
+    def test_answer_post_queries_eligibility_table(self):
+        # a status change refreshes the user's rows with three reads and a
+        # write.
+        self.check_answer_post_queries(SurveyFormView.POST_QUERY_BUDGET + 4)
+
+    def check_answer_post_queries(self, budget):
+        boss_man = self.create_boss_man()
+        questionnaire1 = self.create_questionnaire(boss_man)
+        question2 = questionnaire1.multichoicequestion_set.create(
+            question_order=1,
+            question_text='Question 2')
+        q2option1 = question2.multichoiceoption_set.create(
+            option_order=0,
+            option_text='Option 1',
+            is_correct_option=True)
+        question1 = self.get_question1(questionnaire1)
+        option2 = self.get_option2(question1)
+        guinea_pig = self.create_guinea_pig('thepig')
+        get_snapshot(questionnaire1.pk)
+
+        def post(question, option):
+            request = RequestFactory().post('/survey/', {
+                'survey_id': questionnaire1.pk,
+                'question_id': question.pk,
+                'question': option.pk})
+            request.user = guinea_pig
+            return SurveyFormView.as_view()(request,
+                                            survey_id=questionnaire1.pk)
+
+        # the first answer creates the sheet
+        response, queries = self.count_queries(post, question1, option2)
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(queries <= budget)
+
+        # the last answer completes it
+        response, queries = self.count_queries(post, question2, q2option1)
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(queries <= budget)
+        sheet = AnswerSheet.objects.get(questionnaire=questionnaire1,
+                                        user=guinea_pig)
+        self.assertEqual(sheet.get_status(),
+                         constants.QUESTIONNAIRE_COMPLETED)
+        self.assertEqual(sheet.calculate_score(), 2)
+
+        # options of other questions are not accepted
+        response = post(question2, option2)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(sheet.multichoiceanswer_set.count(), 2)
+
+        questionnaire1.delete()
+        boss_man.delete()
+        guinea_pig.delete()
+
+    @patch.object(SurveyFormView, 'get_success_url',
+                  lambda self, survey_id: '/next/')
+    def test_questions_per_page(self):
+        boss_man = self.create_boss_man()
+        questionnaire1 = self.create_questionnaire(boss_man)
+        questionnaire1.questions_per_page = 2
+        questionnaire1.save()
+        questions = [self.get_question1(questionnaire1)]
+        options = [self.get_option2(questions[0])]
+        for i in range(2, 4):
+            question = questionnaire1.multichoicequestion_set.create(
+                question_order=i,
+                question_text='Question %s' % i)
+            questions.append(question)
+            options.append(question.multichoiceoption_set.create(
+                option_order=0,
+                option_text='Option 1',
+                is_correct_option=True))
+        guinea_pig = self.create_guinea_pig('thepig')
+
+        def get():
+            request = RequestFactory().get('/survey/')
+            request.user = guinea_pig
+            response = SurveyFormView.as_view()(request,
+                                                survey_id=questionnaire1.pk)
+            return response.context_data['form']
+
+        def post(page):
+            data = {'survey_id': questionnaire1.pk,
+                    'question_ids': ','.join(str(q.pk) for q in page)}
+            for question, option in zip(questions, options):
+                if question in page:
+                    data['question_%s' % question.pk] = option.pk
+            request = RequestFactory().post('/survey/', data)
+            request.user = guinea_pig
+            return SurveyFormView.as_view()(request,
+                                            survey_id=questionnaire1.pk)
+
+        # the first page shows two questions, answered with one insert
+        form = get()
+        self.assertEqual(form.questions, list(
+            get_snapshot(questionnaire1.pk).questions[:2]))
+
+        # redirected pages have no token, resending them is idempotent
+        self.assertIsNone(form.fields['page_token'].initial)
+        response, queries = self.count_queries(post, questions[:2])
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(queries <= SurveyFormView.POST_QUERY_BUDGET)
+        sheet = AnswerSheet.objects.get(questionnaire=questionnaire1,
+                                        user=guinea_pig)
+        self.assertEqual(sheet.number_of_questions_answered(), 2)
+        self.assertEqual(sheet.get_status(),
+                         constants.QUESTIONNAIRE_INCOMPLETE)
+
+        # resending the page does not add answers
+        post(questions[:2])
+        self.assertEqual(sheet.multichoiceanswer_set.count(), 2)
+
+        # the last page shows the remaining question
+        form = get()
+        self.assertEqual([q.pk for q in form.questions], [questions[2].pk])
+        post(questions[2:])
+        sheet = AnswerSheet.objects.get(pk=sheet.pk)
+        self.assertEqual(sheet.get_status(),
+                         constants.QUESTIONNAIRE_COMPLETED)
+        self.assertEqual(sheet.calculate_score(), 3)
+
+        questionnaire1.delete()
+        boss_man.delete()
+        guinea_pig.delete()
+
+    @override_settings(SURVEY_RENDER_NEXT_QUESTION=True)
+    def test_render_next_question(self):
+        boss_man = self.create_boss_man()
+        questionnaire1 = self.create_questionnaire(boss_man)
+        question2 = questionnaire1.multichoicequestion_set.create(
+            question_order=1,
+            question_text='Question 2')
+        q2option1 = question2.multichoiceoption_set.create(
+            option_order=0,
+            option_text='Option 1',
+            is_correct_option=True)
+        question1 = self.get_question1(questionnaire1)
+        option2 = self.get_option2(question1)
+        guinea_pig = self.create_guinea_pig('thepig')
+
+        def post(form, option):
+            request = RequestFactory().post('/survey/', {
+                'survey_id': questionnaire1.pk,
+                'question_id': form.questions[0].pk,
+                'question': option.pk,
+                'page_token': form.fields['page_token'].initial})
+            request.user = guinea_pig
+            return SurveyFormView.as_view()(request,
+                                            survey_id=questionnaire1.pk)
+
+        request = RequestFactory().get('/survey/')
+        request.user = guinea_pig
+        response = SurveyFormView.as_view()(request,
+                                            survey_id=questionnaire1.pk)
+        form1 = response.context_data['form']
+
+        # the response to the answer displays the next question
+        response, queries = self.count_queries(post, form1, option2)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(queries <= SurveyFormView.POST_QUERY_BUDGET)
+        form2 = response.context_data['form']
+        self.assertEqual([q.pk for q in form2.questions], [question2.pk])
+
+        # submitting the page again, e.g. after a refresh, changes nothing
+        response = post(form1, option2)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            MultiChoiceAnswer.objects.filter(
+                answer_sheet__user=guinea_pig).count(), 1)
+
+        # a page whose answers could not be stored can be submitted again
+        with patch.object(MultiChoiceAnswer.objects, 'answer_many',
+                          side_effect=DatabaseError):
+            self.assertRaises(DatabaseError, post, form2, q2option1)
+
+        # the response to the last answer is the thank you page
+        response = post(form2, q2option1)
+        self.assertEqual(response.template_name,
+                         'survey/survey_thankyou.html')
+        self.assertEqual(response.context_data['params']['survey'].pk,
+                         questionnaire1.pk)
+
+        questionnaire1.delete()
+        boss_man.delete()
+        guinea_pig.delete()
+
+    @override_settings(SURVEY_TRACK_PROGRESS=True)
+    @patch.object(SurveyFormView, 'get_success_url',
+                  lambda self, survey_id: '/next/')
+    def test_progress_tracker(self):
+        boss_man = self.create_boss_man()
+        questionnaire1 = self.create_questionnaire(boss_man)
+        questions = [self.get_question1(questionnaire1)]
+        options = [self.get_option2(questions[0])]
+        for i in range(2, 4):
+            question = questionnaire1.multichoicequestion_set.create(
+                question_order=i,
+                question_text='Question %s' % i)
+            questions.append(question)
+            options.append(question.multichoiceoption_set.create(
+                option_order=0,
+                option_text='Option 1',
+                is_correct_option=True))
+        guinea_pig = self.create_guinea_pig('thepig')
+        get_snapshot(questionnaire1.pk)
+        caching.reset_stats('progress_hits', 'progress_misses')
+
+        def get(session):
+            request = RequestFactory().get('/survey/')
+            request.user = guinea_pig
+            request.session = session
+            response = SurveyFormView.as_view()(request,
+                                                survey_id=questionnaire1.pk)
+            return response.context_data['form'].questions[0].pk
+
+        def post(session, i):
+            request = RequestFactory().post('/survey/', {
+                'survey_id': questionnaire1.pk,
+                'question_id': questions[i].pk,
+                'question': options[i].pk})
+            request.user = guinea_pig
+            request.session = session
+            SurveyFormView.as_view()(request, survey_id=questionnaire1.pk)
+
+        phone, tablet = {}, {}
+        self.assertEqual(get(phone), questions[0].pk)
+
+        # the answer given is added to the session, no queries are needed to
+        # find the next question.
+        post(phone, 0)
+        question_id, queries = self.count_queries(get, phone)
+        self.assertEqual(question_id, questions[1].pk)
+        self.assertEqual(queries, 0)
+
+        # answering on another device is noticed
+        self.assertEqual(get(tablet), questions[1].pk)
+        post(tablet, 1)
+        self.assertEqual(get(phone), questions[2].pk)
+        self.assertEqual(get(tablet), questions[2].pk)
+        self.assertEqual(
+            caching.get_stats('progress_hits', 'progress_misses'),
+            {'progress_hits': 2, 'progress_misses': 3})
+
+        questionnaire1.delete()
+        boss_man.delete()
+        guinea_pig.delete()
+
+    @override_settings(SURVEY_BUFFER_ANSWERS=True)
+    @patch.object(SurveyFormView, 'get_success_url',
+                  lambda self, survey_id: '/next/')
+    def test_buffered_answers(self):
+        boss_man = self.create_boss_man()
+        questionnaire1 = self.create_questionnaire(boss_man)
+        question2 = questionnaire1.multichoicequestion_set.create(
+            question_order=1,
+            question_text='Question 2')
+        q2option1 = question2.multichoiceoption_set.create(
+            option_order=0,
+            option_text='Option 1',
+            is_correct_option=True)
+        question1 = self.get_question1(questionnaire1)
+        option1 = question1.multichoiceoption_set.get(option_text='Option 1')
+        option2 = self.get_option2(question1)
+        guinea_pig = self.create_guinea_pig('thepig')
+
+        def post(question, option):
+            request = RequestFactory().post('/survey/', {
+                'survey_id': questionnaire1.pk,
+                'question_id': question.pk,
+                'question': option.pk})
+            request.user = guinea_pig
+            return SurveyFormView.as_view()(request,
+                                            survey_id=questionnaire1.pk)
+
+        # answers are buffered with a single insert
+        get_snapshot(questionnaire1.pk)
+        response, queries = self.count_queries(post, question1, option1)
+        self.assertEqual(queries, 1)
+        self.assertFalse(AnswerSheet.objects.filter(
+            user=guinea_pig).exists())
+
+        # the statuses include the buffered answers
+        self.assertEqual(
+            AnswerSheet.objects.status_map(guinea_pig),
+            {questionnaire1.pk: constants.QUESTIONNAIRE_INCOMPLETE})
+        request = RequestFactory().get('/survey/')
+        request.user = guinea_pig
+        response = SurveyFormView.as_view()(request,
+                                            survey_id=questionnaire1.pk)
+        self.assertEqual(response.context_data['form'].questions[0].pk,
+                         question2.pk)
+        post(question2, q2option1)
+        post(question1, option2)
+        self.assertEqual(
+            AnswerSheet.objects.status_map(guinea_pig),
+            {questionnaire1.pk: constants.QUESTIONNAIRE_COMPLETED})
+
+        # a flush that starts while another is running does nothing
+        self.assertTrue(caching.acquire_flush_lock())
+        self.assertIsNone(BufferedAnswer.objects.flush())
+        self.assertEqual(BufferedAnswer.objects.count(), 3)
+        self.assertFalse(AnswerSheet.objects.filter(
+            user=guinea_pig).exists())
+        caching.release_flush_lock()
+
+        # flushing stores the last answer to each question on the sheet
+        survey_flush_answers.Command().handle(batch_size=2)
+        self.assertEqual(BufferedAnswer.objects.count(), 0)
+        sheet = AnswerSheet.objects.get(user=guinea_pig)
+        self.assertEqual(sheet.number_of_questions_answered(), 2)
+        self.assertEqual(sheet.get_status(),
+                         constants.QUESTIONNAIRE_COMPLETED)
+        self.assertEqual(sheet.calculate_score(), 2)
+        self.assertEqual(
+            AnswerSheet.objects.status_map(guinea_pig),
+            {questionnaire1.pk: constants.QUESTIONNAIRE_COMPLETED})
+
+        questionnaire1.delete()
+        boss_man.delete()
+        guinea_pig.delete()
+
 
 class SurveyCommandsTestCase(BaseSurveyTestCase):
 
@@ -517,6 +1398,436 @@ class SurveyCommandsTestCase(BaseSurveyTestCase):
         questionnaire1.delete()
         boss_man.delete()
 
+    def test_streaming_export(self):
+        boss_man = self.create_boss_man()
+        questionnaire1 = self.create_questionnaire(boss_man)
+        questionnaire2 = self.create_questionnaire(boss_man)
+        question1 = self.get_question1(questionnaire1)
+        option2 = self.get_option2(question1)
+        question2 = questionnaire1.multichoicequestion_set.create(
+            question_order=1,
+            question_text='Question 2')
+        q2option1 = question2.multichoiceoption_set.create(
+            option_order=0,
+            option_text='Option 1',
+            is_correct_option=False)
+        guinea_pigs = [self.create_guinea_pig('thepig%s' % i)
+                       for i in range(3)]
+        for guinea_pig in guinea_pigs:
+            sheet = AnswerSheet.objects.create(questionnaire=questionnaire1,
+                                               user=guinea_pig)
+            sheet.multichoiceanswer_set.create(question=question2,
+                                               chosen_option=q2option1)
+            sheet.multichoiceanswer_set.create(question=question1,
+                                               chosen_option=option2)
+        AnswerSheet.objects.create(questionnaire=questionnaire2,
+                                   user=guinea_pigs[0])
+
+        # the rows match the answer sheets
+        expected = []
+        for sheet in AnswerSheet.objects.order_by('questionnaire__id',
+                                                  'user__id'):
+            row = [sheet.user.username, u'Unknown', sheet.questionnaire.title,
+                   "%s" % sheet.date_created, sheet.get_status_text(),
+                   "%s" % sheet.calculate_score()]
+            for answer in sheet.multichoiceanswer_set.all():
+                row.append(answer.question.question_text)
+                row.append(answer.chosen_option.option_text)
+            expected.append(row)
+        rows, queries = self.count_queries(
+            lambda: list(export.iterate_rows(chunk_size=3)))
+        self.assertEqual(rows, expected)
+        self.assertEqual(rows[0][6:], ['Question 1', 'Option 2',
+                                       'Question 2', 'Option 1'])
+
+        # each chunk takes three queries, and one more finds the end
+        self.assertEqual(queries, 7)
+
+        questionnaire1.delete()
+        questionnaire2.delete()
+        boss_man.delete()
+        for guinea_pig in guinea_pigs:
+            guinea_pig.delete()
+
+    def test_incremental_export(self):
+        boss_man = self.create_boss_man()
+        questionnaire1 = self.create_questionnaire(boss_man)
+        question1 = self.get_question1(questionnaire1)
+        option2 = self.get_option2(question1)
+        guinea_pig = self.create_guinea_pig('thepig')
+        guinea_pig2 = self.create_guinea_pig('thepig2')
+        sheet = AnswerSheet.objects.create(questionnaire=questionnaire1,
+                                           user=guinea_pig)
+        AnswerSheet.objects.create(questionnaire=questionnaire1,
+                                   user=guinea_pig2)
+        tmp_dir = tempfile.mkdtemp()
+        watermark_file = os.path.join(tmp_dir, 'export.watermark')
+
+        def export_users(**options):
+            mock_file = StringIO()
+            command = survey_answersheet_csv_export.Command()
+            command.get_file = lambda fn: mock_file
+            command.close_file = lambda fp: True
+            command.handle(watermark_file=watermark_file, **options)
+            return [line.split(',')[0]
+                    for line in mock_file.getvalue().splitlines()[1:]]
+
+        def age_sheets(**kwargs):
+            AnswerSheet.objects.filter(questionnaire=questionnaire1).update(
+                date_last_updated=datetime.datetime.now() -
+                datetime.timedelta(**kwargs))
+
+        # the first incremental run exports everything
+        self.assertEqual(export_users(incremental=True),
+                         ['thepig', 'thepig2'])
+        self.assertTrue(os.path.exists(watermark_file))
+        age_sheets(hours=1)
+        self.assertEqual(export_users(incremental=True), [])
+
+        # answering updates the sheet, which is exported by the next run
+        sheet.multichoiceanswer_set.create(question=question1,
+                                           chosen_option=option2)
+        self.assertEqual(export_users(incremental=True), ['thepig'])
+        age_sheets(hours=1)
+        self.assertEqual(export_users(incremental=True), [])
+
+        # a sheet stamped just before the watermark, by a transaction that
+        # only committed after the last run started, is exported too
+        watermark = export.read_watermark(watermark_file)
+        AnswerSheet.objects.filter(user=guinea_pig2).update(
+            date_last_updated=watermark - datetime.timedelta(seconds=1))
+        self.assertEqual(export_users(incremental=True), ['thepig2'])
+        age_sheets(hours=1)
+
+        # --since does not move the watermark
+        self.assertEqual(export_users(since='2000-01-01'),
+                         ['thepig', 'thepig2'])
+        self.assertEqual(export_users(incremental=True), [])
+
+        shutil.rmtree(tmp_dir)
+        questionnaire1.delete()
+        boss_man.delete()
+        guinea_pig.delete()
+        guinea_pig2.delete()
+
+    def test_per_questionnaire_export(self):
+        boss_man = self.create_boss_man()
+        questionnaire1 = self.create_questionnaire(boss_man)
+        questionnaire2 = self.create_questionnaire(boss_man)
+        guinea_pig = self.create_guinea_pig('thepig')
+        guinea_pig2 = self.create_guinea_pig('thepig2')
+        for user in (guinea_pig, guinea_pig2):
+            sheet = AnswerSheet.objects.create(questionnaire=questionnaire1,
+                                               user=user)
+        question1 = self.get_question1(questionnaire1)
+        sheet.multichoiceanswer_set.create(
+            question=question1,
+            chosen_option=self.get_option2(question1))
+        AnswerSheet.objects.create(questionnaire=questionnaire2,
+                                   user=guinea_pig)
+        tmp_dir = tempfile.mkdtemp()
+
+        command = survey_answersheet_csv_export.Command()
+        command.generate_file_name = lambda: os.path.join(tmp_dir,
+                                                          'answers.csv')
+        command.handle(per_questionnaire=True, workers=1)
+
+        # the manifest lists the files with their rows and checksums
+        with open(os.path.join(tmp_dir, 'answers_manifest.csv')) as fp:
+            manifest = list(csv.reader(fp))[1:]
+        self.assertEqual(
+            [(row[0], row[2], row[3]) for row in manifest],
+            [(str(questionnaire1.pk), 'answers_%s.csv' % questionnaire1.pk,
+              '2'),
+             (str(questionnaire2.pk), 'answers_%s.csv' % questionnaire2.pk,
+              '1')])
+        for row in manifest:
+            with open(os.path.join(tmp_dir, row[2])) as fp:
+                data = fp.read()
+            self.assertEqual(hashlib.sha1(data).hexdigest(), row[4])
+            self.assertEqual(len(data.splitlines()), int(row[3]) + 1)
+
+        # the header of each file is as wide as its own sheets need
+        headers = []
+        for questionnaire in (questionnaire1, questionnaire2):
+            with open(os.path.join(tmp_dir, 'answers_%s.csv' %
+                                   questionnaire.pk)) as fp:
+                headers.append(next(csv.reader(fp)))
+        self.assertEqual(headers, [export.header_row(1),
+                                   export.header_row(0)])
+
+        shutil.rmtree(tmp_dir)
+        questionnaire1.delete()
+        questionnaire2.delete()
+        boss_man.delete()
+        guinea_pig.delete()
+        guinea_pig2.delete()
+
+    def test_wide_export(self):
+        boss_man = self.create_boss_man()
+        questionnaire1 = self.create_questionnaire(boss_man)
+        question1 = self.get_question1(questionnaire1)
+        option2 = self.get_option2(question1)
+        question2 = questionnaire1.multichoicequestion_set.create(
+            question_order=1,
+            question_text='Question 2')
+        q2option1 = question2.multichoiceoption_set.create(
+            option_order=0,
+            option_text='Option A',
+            is_correct_option=True)
+        guinea_pig = self.create_guinea_pig('thepig')
+        guinea_pig2 = self.create_guinea_pig('thepig2')
+        sheet = AnswerSheet.objects.create(questionnaire=questionnaire1,
+                                           user=guinea_pig)
+        sheet.multichoiceanswer_set.create(question=question2,
+                                           chosen_option=q2option1)
+        sheet2 = AnswerSheet.objects.create(questionnaire=questionnaire1,
+                                            user=guinea_pig2)
+        sheet2.multichoiceanswer_set.create(question=question1,
+                                            chosen_option=option2)
+        get_snapshot(questionnaire1.pk)
+
+        # every question has its own column, in question order
+        rows, queries = self.count_queries(lambda: list(
+            export.iterate_wide_rows(questionnaire1.pk)))
+        self.assertEqual(rows[0], export.WIDE_HEADER + ['Question 1',
+                                                        'Question 2'])
+        self.assertEqual([row[:1] + row[3:] for row in rows[1:]],
+                         [['thepig', 'Incomplete', '1', '', 'Option A'],
+                          ['thepig2', 'Incomplete', '1', 'Option 2', '']])
+
+        # a chunk of sheets takes three queries, and one more finds the end
+        self.assertEqual(queries, 4)
+
+        questionnaire1.delete()
+        boss_man.delete()
+        guinea_pig.delete()
+        guinea_pig2.delete()
+
+    def test_compressed_export(self):
+        boss_man = self.create_boss_man()
+        questionnaire1 = self.create_questionnaire(boss_man)
+        guinea_pig = self.create_guinea_pig('thepig')
+        AnswerSheet.objects.create(questionnaire=questionnaire1,
+                                   user=guinea_pig)
+        tmp_dir = tempfile.mkdtemp()
+
+        command = survey_answersheet_csv_export.Command()
+        command.generate_file_name = lambda: 'answers.csv'
+        command.handle(gzip=True, output_dir=tmp_dir)
+
+        # only the finished file is left in the output directory
+        self.assertEqual(os.listdir(tmp_dir), ['answers.csv.gz'])
+        with gzip.open(os.path.join(tmp_dir, 'answers.csv.gz')) as fp:
+            rows = list(csv.reader(fp))
+        self.assertEqual(rows[0], export.header_row(0))
+        self.assertEqual(rows[1][0], 'thepig')
+
+        # a failed export leaves no file behind
+        with patch.object(export, 'write_csv', side_effect=DatabaseError):
+            self.assertRaises(DatabaseError, command.handle,
+                              output_dir=tmp_dir)
+        self.assertEqual(os.listdir(tmp_dir), ['answers.csv.gz'])
+
+        # the manifest has the checksums of the compressed files
+        command.handle(gzip=True, output_dir=tmp_dir, per_questionnaire=True)
+        with open(os.path.join(tmp_dir, 'answers_manifest.csv')) as fp:
+            manifest = list(csv.reader(fp))[1:]
+        shard = 'answers_%s.csv.gz' % questionnaire1.pk
+        self.assertEqual([row[2] for row in manifest], [shard])
+        with open(os.path.join(tmp_dir, shard), 'rb') as fp:
+            self.assertEqual(hashlib.sha1(fp.read()).hexdigest(),
+                             manifest[0][4])
+        with gzip.open(os.path.join(tmp_dir, shard)) as fp:
+            self.assertEqual(len(fp.read().splitlines()), 2)
+
+        shutil.rmtree(tmp_dir)
+        questionnaire1.delete()
+        boss_man.delete()
+        guinea_pig.delete()
+
+    @unittest.skipIf(export.numpy is None, 'numpy is not installed')
+    def test_answer_matrix_export(self):
+        boss_man = self.create_boss_man()
+        questionnaire1 = self.create_questionnaire(boss_man)
+        question1 = self.get_question1(questionnaire1)
+        option2 = self.get_option2(question1)
+        question2 = questionnaire1.multichoicequestion_set.create(
+            question_order=1,
+            question_text=u'Qüestion 2')
+        q2option1 = question2.multichoiceoption_set.create(
+            option_order=0,
+            option_text='Option A',
+            is_correct_option=True)
+        guinea_pig = self.create_guinea_pig('thepig')
+        guinea_pig2 = self.create_guinea_pig('thepig2')
+        sheet = AnswerSheet.objects.create(questionnaire=questionnaire1,
+                                           user=guinea_pig)
+        sheet.multichoiceanswer_set.create(question=question2,
+                                           chosen_option=q2option1)
+        sheet2 = AnswerSheet.objects.create(questionnaire=questionnaire1,
+                                            user=guinea_pig2)
+        sheet2.multichoiceanswer_set.create(question=question1,
+                                            chosen_option=option2)
+        tmp_dir = tempfile.mkdtemp()
+
+        command = survey_answersheet_csv_export.Command()
+        command.generate_file_name = lambda: 'answers.csv'
+        command.handle(npz=True, output_dir=tmp_dir, chunk_size=1)
+
+        matrix_file = 'answers_%s.npz' % questionnaire1.pk
+        self.assertEqual(os.listdir(tmp_dir), [matrix_file])
+        arrays = export.numpy.load(os.path.join(tmp_dir, matrix_file))
+        self.assertEqual(list(arrays['user_ids']),
+                         [guinea_pig.pk, guinea_pig2.pk])
+        self.assertEqual(arrays['chosen_options'].tolist(),
+                         [[-1, q2option1.pk], [option2.pk, -1]])
+        self.assertEqual(arrays['correct'].tolist(),
+                         [[False, True], [True, False]])
+        self.assertEqual(list(arrays['question_texts']),
+                         [u'Question 1', u'Qüestion 2'])
+        options = dict(zip(arrays['option_ids'], arrays['option_texts']))
+        self.assertEqual(options[q2option1.pk], u'Option A')
+        arrays.close()
+
+        shutil.rmtree(tmp_dir)
+        questionnaire1.delete()
+        boss_man.delete()
+        guinea_pig.delete()
+        guinea_pig2.delete()
+
+    def test_answer_matrix_requires_numpy(self):
+        command = survey_answersheet_csv_export.Command()
+        with patch.object(export, 'numpy', None):
+            self.assertRaises(CommandError, command.handle, npz=True)
+
+    def test_admin_export(self):
+        boss_man = self.create_boss_man()
+        questionnaire1 = self.create_questionnaire(boss_man)
+        questionnaire2 = self.create_questionnaire(boss_man)
+        guinea_pigs = [self.create_guinea_pig('thepig%s' % idx)
+                       for idx in range(3)]
+        for guinea_pig in guinea_pigs:
+            AnswerSheet.objects.create(questionnaire=questionnaire1,
+                                       user=guinea_pig)
+        AnswerSheet.objects.create(questionnaire=questionnaire2,
+                                   user=guinea_pigs[0])
+        request = RequestFactory().get('/')
+        request.user = boss_man
+
+        def exported_users(response):
+            self.assertEqual(response['Content-Type'], 'text/csv')
+            self.assertIn('attachment', response['Content-Disposition'])
+            return [row[0] for row in
+                    csv.reader(StringIO(''.join(response)))][1:]
+
+        # the action streams the selected sheets in chunks
+        sheet_admin = AnswerSheetAdmin(AnswerSheet, admin.site)
+        queryset = AnswerSheet.objects.filter(
+            user__in=guinea_pigs[1:]).order_by('-user')
+        response = sheet_admin.export_as_csv(request, queryset)
+        self.assertTrue(response._base_content_is_iter)
+        self.assertEqual(exported_users(response), ['thepig1', 'thepig2'])
+        self.assertEqual(
+            len(list(export.stream_csv(queryset, chunk_size=1))), 3)
+
+        # the response is read after request_finished closed the connection,
+        # and closes the connection the export opened again
+        response = sheet_admin.export_as_csv(request, queryset)
+        request_finished.send(sender=self.__class__)
+        with patch.object(connections['default'], 'close') as close:
+            self.assertEqual(exported_users(response),
+                             ['thepig1', 'thepig2'])
+        self.assertEqual(close.call_count, 1)
+
+        # a failure part way through is marked at the end of the file
+        with patch.object(export, 'chunk_rows', side_effect=DatabaseError):
+            chunks = export.stream_csv(queryset)
+            rows = list(csv.reader(StringIO(chunks.next())))
+            self.assertRaises(DatabaseError, chunks.next)
+        self.assertEqual(rows[-1], export.STREAM_ERROR_ROW)
+
+        # the questionnaire download has the sheets of the questionnaire
+        questionnaire_admin = QuestionnaireAdmin(Questionnaire, admin.site)
+        response = questionnaire_admin.export_answer_sheets(
+            request, str(questionnaire2.pk))
+        self.assertEqual(exported_users(response), ['thepig0'])
+
+        questionnaire1.delete()
+        questionnaire2.delete()
+        boss_man.delete()
+        for guinea_pig in guinea_pigs:
+            guinea_pig.delete()
+
+    def test_resume_export(self):
+        boss_man = self.create_boss_man()
+        questionnaire1 = self.create_questionnaire(boss_man)
+        questionnaire2 = self.create_questionnaire(boss_man)
+        guinea_pigs = [self.create_guinea_pig('thepig%s' % idx)
+                       for idx in range(3)]
+        for questionnaire in (questionnaire1, questionnaire2):
+            for guinea_pig in guinea_pigs:
+                AnswerSheet.objects.create(questionnaire=questionnaire,
+                                           user=guinea_pig)
+        tmp_dir = tempfile.mkdtemp()
+        checkpoint_file = os.path.join(tmp_dir, 'answers.checkpoint')
+
+        command = survey_answersheet_csv_export.Command()
+        command.generate_file_name = lambda: 'expected.csv'
+        command.handle(output_dir=tmp_dir)
+        with open(os.path.join(tmp_dir, 'expected.csv')) as fp:
+            expected = fp.read()
+
+        get_mobile_numbers = export.get_mobile_numbers
+        command.generate_file_name = lambda: 'answers.csv'
+        for compress in (False, True):
+            filename = os.path.join(tmp_dir, 'answers.csv')
+            if compress:
+                filename += '.gz'
+
+            # the export fails on the third chunk
+            calls = []
+
+            def failing_mobile_numbers(user_ids):
+                calls.append(user_ids)
+                if len(calls) == 3:
+                    raise DatabaseError
+                return get_mobile_numbers(user_ids)
+
+            with patch.object(export, 'get_mobile_numbers',
+                              side_effect=failing_mobile_numbers):
+                self.assertRaises(DatabaseError, command.handle,
+                                  output_dir=tmp_dir, chunk_size=2,
+                                  gzip=compress, checkpoint=True,
+                                  checkpoint_file=checkpoint_file)
+            self.assertFalse(os.path.exists(filename))
+            checkpoint = export.read_checkpoint(checkpoint_file)
+            self.assertEqual(checkpoint['rows'], 4)
+            self.assertEqual(
+                (checkpoint['questionnaire'], checkpoint['user']),
+                (questionnaire2.pk, guinea_pigs[0].pk))
+
+            # resuming finishes the same file, and removes the checkpoint
+            command.handle(resume=True, chunk_size=2,
+                           checkpoint_file=checkpoint_file)
+            self.assertFalse(os.path.exists(checkpoint_file))
+            if compress:
+                with gzip.open(filename) as fp:
+                    self.assertEqual(fp.read(), expected)
+            else:
+                with open(filename) as fp:
+                    self.assertEqual(fp.read(), expected)
+
+        self.assertRaises(CommandError, command.handle, resume=True,
+                          checkpoint_file=checkpoint_file)
+
+        shutil.rmtree(tmp_dir)
+        questionnaire1.delete()
+        questionnaire2.delete()
+        boss_man.delete()
+        for guinea_pig in guinea_pigs:
+            guinea_pig.delete()
+
 
 class ContentQuizTestCase(BaseSurveyTestCase):
     """ Test the functionality of the Content Linked Survey
@@ -592,3 +1903,42 @@ class ContentQuizTestCase(BaseSurveyTestCase):
         boss_man.delete()
         questionnaire1.delete()
         guinea_pig.delete()
+
+    @override_settings(SURVEY_USE_ELIGIBILITY_TABLE=True)
+    def test_post_content_quizzes_eligibility_table(self):
+        boss_man = self.create_boss_man()
+        guinea_pig = self.create_guinea_pig('thepig')
+        post = Post.objects.create(
+            content='This is Test content',
+            state='published',
+            slug='test-content',
+            title='Test Content',
+            owner=boss_man
+        )
+        quizzes = []
+        for active in (True, False):
+            content_quiz = ContentQuiz.objects.create(
+                banner_description='This is an Content banner',
+                introduction_text='Content Intro text',
+                thank_you_text='Content Thank you',
+                created_by=boss_man,
+                active=active
+            )
+            ContentQuizToPost.objects.create(post=post, quiz=content_quiz)
+            quizzes.append(content_quiz)
+
+        # the statuses come from the table, the inactive quiz has no row
+        context = post_content_quizzes({'user': guinea_pig}, post)
+        self.assertEqual(context['quizzes'], quizzes)
+        self.assertEqual(
+            UserSurveyEligibility.objects.filter(user=guinea_pig).count(), 1)
+        UserSurveyEligibility.objects.filter(user=guinea_pig).update(
+            status=constants.QUESTIONNAIRE_COMPLETED)
+        context = post_content_quizzes({'user': guinea_pig}, post)
+        self.assertEqual(context['quizzes'], quizzes[1:])
+
+        post.delete()
+        for content_quiz in quizzes:
+            content_quiz.delete()
+        boss_man.delete()
+        guinea_pig.delete()
@@ -1,10 +1,27 @@
-from django.http import HttpResponseRedirect
+from django.conf import settings
+from django.core import signing
+from django.http import HttpResponseRedirect, Http404
+from django.utils.crypto import get_random_string
 from django.views.generic.base import View, RedirectView, TemplateView
 from django.views.generic.edit import FormView
 from django.core.urlresolvers import reverse
 
-from survey.models import Questionnaire, MultiChoiceQuestion, AnswerSheet
-from survey.forms import SurveyChoiceForm, SurveyQuestionForm
+from survey import caching
+from survey.models import (Questionnaire, AnswerSheet, MultiChoiceAnswer,
+                           BufferedAnswer, use_answer_buffer)
+from survey.snapshot import get_snapshot
+from survey.progress import ProgressTracker, track_progress
+from survey.forms import (SurveyChoiceForm, SurveyQuestionForm,
+                          SurveyQuestionsForm)
+
+PAGE_TOKEN_SALT = 'survey.views.page_token'
+
+
+def render_next_question():
+    """ Whether the response to answering a page of questions displays the
+        next page, instead of redirecting to it.
+    """
+    return getattr(settings, 'SURVEY_RENDER_NEXT_QUESTION', False)
 
 
 class CheckForQuestionnaireView(RedirectView):
@@ -16,12 +33,19 @@ class CheckForQuestionnaireView(RedirectView):
 
     def get_redirect_url(self, **kwargs):
         user = self.request.user
-        profile = user.profile
-        if not profile.decline_surveys:
-            questionnaire = Questionnaire.objects.questionnaire_for_user(user)
-            if questionnaire:
-                return reverse('survey:survey_action',
-                               args=(questionnaire.pk,))
+
+        # most users have nothing available, remember that to skip the
+        # survey queries on their next login.
+        version, nothing_available = caching.get_nothing_available(user.pk)
+        if not nothing_available:
+            profile = user.profile
+            if not profile.decline_surveys:
+                questionnaire = Questionnaire.objects.questionnaire_for_user(
+                    user)
+                if questionnaire:
+                    return reverse('survey:survey_action',
+                                   args=(questionnaire.pk,))
+            caching.set_nothing_available(user.pk, version)
 
         return super(CheckForQuestionnaireView,
                      self).get_redirect_url(**kwargs)
@@ -74,23 +98,67 @@ class SurveyFormView(FormView):
     template_name = "survey/survey_form.html"
     form_class = SurveyQuestionForm
 
+    # the most queries answering a page of questions takes: reading or
+    # creating the sheet, inserting the answers and updating the sheet's
+    # answer count and status.
+    POST_QUERY_BUDGET = 6
+
+    # whether the page shows a field for each of several questions
+    multiple_questions = False
+
+    def get_form_class(self):
+        """ Questionnaires showing more than one question on a page use a form
+            with a field for each question.
+        """
+        if self.multiple_questions:
+            return SurveyQuestionsForm
+        return super(SurveyFormView, self).get_form_class()
+
     def get(self, request, *args, **kwargs):
         user = self.request.user
         survey_id = kwargs.get('survey_id', None)
 
-        # find the next question to display
-        survey = Questionnaire.objects.get(pk=survey_id)
-        next_question = survey.get_next_question_for_user(user)
-        if next_question is None:
+        # find the next questions to display, the questionnaire content comes
+        # from its cached snapshot.
+        snapshot = get_snapshot(survey_id)
+        if track_progress():
+            answered = ProgressTracker(request.session, user.pk,
+                                       snapshot.pk).answered_question_ids()
+        else:
+            answered = MultiChoiceAnswer.objects.answered_question_ids(
+                user.pk, snapshot.pk)
+        next_questions = snapshot.next_questions(
+            answered, snapshot.questions_per_page)
+        if not next_questions:
             return HttpResponseRedirect(reverse('survey:thankyou_page',
                                                 args=(survey_id,)))
 
+        self.snapshot = snapshot
+        return self.render_questions(survey_id, next_questions)
+
+    def render_questions(self, survey_id, questions):
+        """ Display the form for a page of questions. If the next page is
+            displayed in the response to the answers, the page gets a signed
+            token, so that submitting it more than once can be detected.
+        """
         # create the form
+        self.multiple_questions = self.snapshot.questions_per_page > 1
         form_class = self.get_form_class()
-        form = self.get_form(form_class)
+        form = form_class(initial=self.get_initial())
 
         # store the survey id in the form
-        form.update_the_form(survey_id, next_question)
+        if self.multiple_questions:
+            form.add_the_questions(survey_id, questions,
+                                   self.snapshot.version)
+        else:
+            form.update_the_form(survey_id, questions[0],
+                                 self.snapshot.version)
+        if render_next_question():
+            form.fields['page_token'].initial = signing.dumps(
+                [self.request.user.pk, self.snapshot.pk,
+                 [the_question.pk for the_question in questions],
+                 get_random_string(12)],
+                salt=PAGE_TOKEN_SALT)
 
         # display the form
         return self.render_to_response(self.get_context_data(
@@ -102,14 +170,31 @@ class SurveyFormView(FormView):
         if request.POST.get('submit') == 'Exit':
             return HttpResponseRedirect(reverse('survey:exit_page'))
 
+        # get the choices for the question fields from the questionnaire
+        # snapshot, so only questions of this questionnaire are accepted.
+        survey_id = request.POST.get('survey_id')
+        try:
+            self.snapshot = get_snapshot(survey_id)
+        except (Questionnaire.DoesNotExist, TypeError, ValueError):
+            raise Http404
+        self.multiple_questions = 'question_ids' in request.POST
+        if self.multiple_questions:
+            question_ids = request.POST['question_ids'].split(',')
+        else:
+            question_ids = [request.POST.get('question_id')]
+        questions = [self.snapshot.get_question(question_id)
+                     for question_id in question_ids]
+        if None in questions:
+            raise Http404
+
+        # the page that was submitted decides the form, not the current
+        # questionnaire setting.
         form_class = self.get_form_class()
         form = self.get_form(form_class)
-
-        # get the choices for the question field, and the hidden field data.
-        survey_id = request.POST.get('survey_id')
-        question_id = request.POST.get('question_id')
-        question = MultiChoiceQuestion.objects.get(pk=question_id)
-        form.update_the_form(survey_id, question)
+        if self.multiple_questions:
+            form.add_the_questions(survey_id, questions)
+        else:
+            form.update_the_form(survey_id, questions[0])
 
         if form.is_valid():
             return self.form_valid(form)
@@ -123,27 +208,101 @@ class SurveyFormView(FormView):
             survey_id=survey_id))
 
     def form_valid(self, form):
-        survey_id = form.cleaned_data['survey_id']
+        """ Store the answers. The questions and options were validated
+            against the snapshot, so the sheet and the answers are written by
+            id without loading them first, within POST_QUERY_BUDGET queries.
+        """
+        survey_id = self.snapshot.pk
         user = self.request.user
-        survey = Questionnaire.objects.get(pk=survey_id)
-
-        sheet, created = AnswerSheet.objects.get_or_create(
-            questionnaire=survey,
-            user=user)
 
-        # retrieve the question and answer values
-        question_id = form.cleaned_data['question_id']
-        question = MultiChoiceQuestion.objects.get(pk=question_id)
-        selected_option_id = form.cleaned_data['question']
-        answer = question.multichoiceoption_set.get(pk=selected_option_id)
-
-        # create the answer instance
-        sheet.multichoiceanswer_set.create(question=question,
-                                           chosen_option=answer)
+        nonce = self.get_page_nonce(form)
+        resubmitted = nonce is not None and caching.page_token_used(nonce)
+
+        # buffered answers are stored without the sheet
+        sheet = None
+        if not use_answer_buffer():
+            sheet, created = AnswerSheet.objects.get_or_create(
+                questionnaire_id=survey_id,
+                user=user)
+
+        # store the answers, a submit that was sent twice without a token
+        # replaces the answers instead of adding more. The token is only
+        # marked as used once the answers are stored, so that the page can
+        # be submitted again if storing them failed.
+        if not resubmitted:
+            answers = form.get_answers()
+            tracker = None
+            if track_progress():
+                tracker = ProgressTracker(self.request.session, user.pk,
+                                          survey_id)
+                tracker.begin_answers()
+            if sheet is None:
+                BufferedAnswer.objects.buffer(user.pk, survey_id, answers)
+            else:
+                MultiChoiceAnswer.objects.answer_many(sheet, answers)
+            if tracker is not None:
+                tracker.answers_stored(
+                    [question_id for question_id, option_id in answers])
+            if nonce is not None:
+                caching.use_page_token(nonce)
+
+        if render_next_question():
+            return self.render_next_page(sheet, form.questions)
 
         # redirect to the next question
         return HttpResponseRedirect(self.get_success_url(survey_id))
 
+    def get_page_nonce(self, form):
+        """ Return the nonce of the page token of a valid form, or None if
+            the form has no valid token for the page. Tokens are only checked
+            if the next page is displayed in the response to the answers,
+            answers submitted again after a redirect replace the stored ones.
+        """
+        if not render_next_question():
+            return None
+        try:
+            user_id, survey_id, question_ids, nonce = signing.loads(
+                form.cleaned_data.get('page_token') or '',
+                salt=PAGE_TOKEN_SALT)
+        except (signing.BadSignature, TypeError, ValueError):
+            return None
+        question_ids_posted = [the_question.pk
+                               for the_question in form.questions]
+        if (user_id != self.request.user.pk or
+                survey_id != self.snapshot.pk or
+                question_ids != question_ids_posted):
+            return None
+        return nonce
+
+    def render_next_page(self, sheet, questions):
+        """ Display the questions following the ones just answered, or the
+            'Thank you' page, in the response to the answers.
+        """
+        snapshot = self.snapshot
+
+        # the sheet's answer count tells whether all the questions before
+        # the answered ones were answered too, in which case the next page
+        # is known without querying the answers.
+        last = max(snapshot.questions.index(the_question)
+                   for the_question in questions)
+        remaining = snapshot.questions[last + 1:]
+        if sheet is not None and sheet.answers_count + len(remaining) == \
+                snapshot.number_of_questions:
+            next_questions = remaining[:snapshot.questions_per_page]
+        else:
+            answered = MultiChoiceAnswer.objects.answered_question_ids(
+                self.request.user.pk, snapshot.pk)
+            next_questions = snapshot.next_questions(
+                answered, snapshot.questions_per_page)
+
+        if not next_questions:
+            return self.response_class(
+                request=self.request,
+                template=SurveyThankyouView.template_name,
+                context={'params': {'survey_id': snapshot.pk,
+                                    'survey': snapshot}})
+        return self.render_questions(snapshot.pk, next_questions)
+
     def get_success_url(self, survey_id):
         return reverse('survey:survey_form', args=(survey_id,))
 